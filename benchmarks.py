@@ -0,0 +1,186 @@
+import json
+import time
+import threading
+import numpy as np
+import pandas as pd
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import centroids
+import osrm_interface
+
+
+class StubOSRMHandler(BaseHTTPRequestHandler):
+    '''
+    Answers OSRM /table requests with made up durations, derived from the
+    longitudes of the locations so that they do not depend on how the request
+    was batched, after sleeping for
+    the server's latency, so request throughput can be measured without a
+    routing server.
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        coordinates = url.path.split('/')[-1].split(';')
+        params = parse_qs(url.query)
+
+        sources = params.get('sources', [None])[0]
+        sources = [int(x) for x in sources.split(';')] if sources else range(len(coordinates))
+        destinations = params.get('destinations', [None])[0]
+        destinations = [int(x) for x in destinations.split(';')] if destinations else range(len(coordinates))
+
+        time.sleep(self.server.latency)
+
+        lons = [float(c.split(',')[0]) for c in coordinates]
+        body = json.dumps({'code': 'Ok',
+                           'durations': [[round(1e6 * abs(lons[s] - lons[d]), 1) for d in destinations]
+                                         for s in sources]}).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_osrm_server(latency=0.01, port=0):
+    '''
+    Starts a stub OSRM server in a background thread.
+
+    Parameters
+    ----------
+    latency : float, default 0.01
+        Seconds the server waits before answering each request
+    port : int, default 0
+        Port to listen on, 0 picks a free port
+
+    Returns
+    -------
+    Tuple of the running server and the base url to pass to get_durations
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubOSRMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, osrm_interface.create_base_url(*server.server_address)
+
+
+def synthetic_osrm_inputs(n_origins, n_destinations):
+    '''
+    Creates OSRM input packages where every origin has n_destinations
+    destinations, the first of which is the origin itself.
+    '''
+    inputs = {}
+    for o in range(n_origins):
+        origin = str(o).zfill(11)
+        dests = [origin] + [str((o + d) % n_origins).zfill(11) for d in range(1, n_destinations)]
+        inputs[origin] = {'destinations': dests,
+                          'coordinates': [f'-87.{int(x):06d},41.{int(x):06d}' for x in dests]}
+
+    return inputs
+
+
+def bench_iter_durations(n_origins=500, n_destinations=50, latency=0.01, workers=(1, 4, 16),
+                         max_table_sizes=(None, 100)):
+    '''
+    Times iter_durations against a stub OSRM server for each number of
+    workers and table size and prints the throughput in origins per second.
+    '''
+    server, base_url = start_stub_osrm_server(latency)
+    inputs = synthetic_osrm_inputs(n_origins, n_destinations)
+
+    try:
+        for size in max_table_sizes:
+            n_requests = len(osrm_interface.plan_batches(inputs, size))
+            for n in workers:
+                start = time.time()
+                with osrm_interface.OSRMClient(base_url, pool_size=n) as client:
+                    for _ in osrm_interface.iter_durations(client, inputs, workers=n, max_table_size=size):
+                        pass
+                elapsed = time.time() - start
+                print(f'iter_durations workers={n} max_table_size={size} requests={n_requests}: '
+                      f'{elapsed:.2f}s ({n_origins / elapsed:.1f} origins/s)')
+    finally:
+        server.shutdown()
+
+
+def synthetic_odpairs(n_origins=2000, n_destinations=40, seed=0):
+    '''
+    Creates an odpairs DataFrame shaped like a tract-level state, where every
+    origin is paired with itself and n_destinations - 1 nearby tracts.
+    '''
+    rng = np.random.default_rng(seed)
+    geoids = 17031000000 + np.arange(n_origins)
+    x = rng.uniform(-91, -87, n_origins)
+    y = rng.uniform(37, 42, n_origins)
+
+    o = np.repeat(np.arange(n_origins), n_destinations)
+    d = (o + np.tile(np.arange(n_destinations), n_origins)) % n_origins
+    mappings = pd.DataFrame({'origin': geoids[o], 'oX': x[o], 'oY': y[o],
+                             'destination': geoids[d], 'dX': x[d], 'dY': y[d]})
+
+    return mappings.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return result, time.time() - start
+
+
+def bench_create_json_obj(n_origins=2000, n_destinations=40):
+    '''
+    Times create_json_obj_df against create_json_obj_dep on synthetic odpairs
+    and checks that both build the same packages.
+    '''
+    mappings = synthetic_odpairs(n_origins, n_destinations)
+
+    old, old_time = timed(osrm_interface.create_json_obj_dep, mappings.copy())
+    new, new_time = timed(osrm_interface.create_json_obj_df, mappings)
+
+    assert old == new, 'create_json_obj_df does not match create_json_obj_dep'
+    print(f'create_json_obj_dep: {old_time:.2f}s, create_json_obj_df: {new_time:.2f}s '
+          f'({old_time / new_time:.0f}x faster) for {len(mappings)} odpairs')
+
+
+def synthetic_blocks(n_blocks=300000, n_units=3000, seed=0):
+    '''
+    Creates block level coordinates and populations for a large state, spread
+    over n_units tracts.
+    '''
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'GEOID': np.arange(n_blocks).astype(str),
+                         'Y': rng.uniform(-1e6, 1e6, n_blocks),
+                         'X': rng.uniform(-1e6, 1e6, n_blocks),
+                         'POP': rng.integers(0, 200, n_blocks),
+                         'TRACT': (17031000000 + rng.integers(0, n_units, n_blocks)).astype(str)})
+
+
+def bench_pop_weighted_centroids(n_blocks=300000, n_units=3000):
+    '''
+    Times aggregate_pop_weighted against the per-unit np.average lambda it
+    replaced and checks that both give the same centroids.
+    '''
+    blocks = synthetic_blocks(n_blocks, n_units)
+
+    def old(geo_w_pop):
+        wm = lambda x: np.average(x, weights=geo_w_pop.loc[x.index, "POP"] + 1)
+        return geo_w_pop.groupby('TRACT').agg({'Y': wm, 'X': wm, 'POP': 'sum'}).reset_index()
+
+    expected, old_time = timed(old, blocks)
+    result, new_time = timed(centroids.aggregate_pop_weighted, blocks, 'TRACT')
+
+    pd.testing.assert_frame_equal(expected, result, check_dtype=False, rtol=1e-9)
+    print(f'np.average lambda: {old_time:.2f}s, aggregate_pop_weighted: {new_time:.2f}s '
+          f'({old_time / new_time:.0f}x faster) for {n_blocks} blocks')
+
+
+if __name__ == '__main__':
+    bench_iter_durations()
+    bench_create_json_obj()
+    bench_pop_weighted_centroids()
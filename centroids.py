@@ -1,16 +1,20 @@
 import os
-import numpy as np
 import pandas as pd
 import geopandas as gpd
-from simpledbf import Dbf5
 import utils
+import dbf_reader
 
 NAME = {'block': 'TABBLOCK',
         'tract': 'TRACT',
         'county': 'COUNTY',
         'zip': 'ZCTA5'}
 
-def compute_geo_centroids(state_abbr, geo, outpath, year=2010, replace = False):
+# Length of the block GEOID10 prefix that is the GEOID10 of the unit holding
+# the block. ZCTAs are not nested in blocks and need a spatial join.
+PREFIX = {'tract': 11,
+          'county': 5}
+
+def compute_geo_centroids(state_abbr, geo, outpath, year=2010, replace = False, extract = True):
     '''
     Computes the population weighted centroids of all boundaries at the desired
     level (block, tract, county, zip) within a designated state.
@@ -23,6 +27,9 @@ def compute_geo_centroids(state_abbr, geo, outpath, year=2010, replace = False):
         String name of the boundary level to use
     outpath : str
         Path of directory where output folder should be created
+    extract : bool, default True
+        Extract the downloaded zips, if False the block DBFs and shapefiles
+        are read from the archives
 
     Returns
     -------
@@ -35,7 +42,7 @@ def compute_geo_centroids(state_abbr, geo, outpath, year=2010, replace = False):
     print(f'-------------Now processing {state_abbr.upper()}-------------')
 
     for geo_type in ['block_pop', 'block', geo]:
-        dl_dir, out_dir, file = utils.get_resource(state_abbr, geo_type, outpath)
+        dl_dir, out_dir, file = utils.get_resource(state_abbr, geo_type, outpath, year = year, extract = extract)
 
         out_dirs[geo_type] = out_dir
         dl_dirs[geo_type] = dl_dir
@@ -44,14 +51,13 @@ def compute_geo_centroids(state_abbr, geo, outpath, year=2010, replace = False):
     file_path = os.path.join(out_dirs[geo], f'{state_abbr.upper()}-pwc-{NAME[geo]}.csv')
 
     if not os.path.isfile(file_path) or replace:
-        block_path = os.path.join(dl_dirs['block'], files['block'])
-        pop_path   = os.path.join(dl_dirs['block_pop'], files['block_pop'])
+        block_path = utils.resource_path(dl_dirs['block'], files['block'], '.dbf')
+        pop_path   = utils.resource_path(dl_dirs['block_pop'], files['block_pop'], '.dbf')
 
         coords_w_pop = get_block_coords_w_pop(block_path, pop_path)
 
-        geo_file = files[geo][:-4] + '.shp'
-        geo_path = os.path.join(dl_dirs[geo], geo_file)
-        geo_shape  = gpd.read_file(geo_path)
+        geo_shape = utils.read_resource(state_abbr, geo, outpath, columns = ['GEOID10'],
+                                        geometry = geo not in PREFIX, year = year, extract = extract)
 
         pop_weighted_centroids = calc_pop_weighted_centroids(coords_w_pop, geo_shape, geo)
 
@@ -79,13 +85,9 @@ def get_block_coords_w_pop(block_path, pop_path):
     coords_w_pop : GeoDataFrame
         Block level coordinates and population figures joined from block level data
     '''
-    block_coords = Dbf5(block_path).to_dataframe()
-    block_pop    = Dbf5(pop_path).to_dataframe()
-
-    # Fix lat lon strings
-    print('Fixing lat/lon strings from DBFs...')
-    block_coords['INTPTLAT10'] = block_coords['INTPTLAT10'].str.replace('+', '').astype(float)
-    block_coords['INTPTLON10'] = block_coords['INTPTLON10'].astype(float)
+    block_coords = dbf_reader.read_dbf(block_path, ['GEOID10', 'INTPTLAT10', 'INTPTLON10'],
+                                       dtypes = {'INTPTLAT10': float, 'INTPTLON10': float})
+    block_pop    = dbf_reader.read_dbf(pop_path, ['BLOCKID10', 'POP10'])
 
     # Merge block pops with block points
     print('Merging block locations and block populations...')
@@ -112,7 +114,8 @@ def calc_pop_weighted_centroids(coords_w_pop, geo_shape, geo):
     coords_w_pop : GeoDataFrame
         GeoDataFrame containing block level centroid coordinates and population
     geo_shape : GeoDataFrame
-        Boundary file for the geometry for which centroids should be computed
+        Boundary file for the geometry for which centroids should be computed.
+        For tracts and counties only its GEOID10 column is used.
     geo : {'tract', 'county', 'zip'}
         String name of the boundary level to use
 
@@ -122,9 +125,17 @@ def calc_pop_weighted_centroids(coords_w_pop, geo_shape, geo):
     X, Y coordinates of the population centroid and the sum of the population within
     the boundary.
     '''
-    # Merge geo that each block centroid falls within
-    geo_shape  = geo_shape[['GEOID10', 'geometry']].rename(columns={'GEOID10': NAME[geo]})
-    geo_w_pop = gpd.sjoin(coords_w_pop, geo_shape, how='left', op='intersects')
+    if geo in PREFIX:
+        # Blocks are nested in tracts and counties, so their GEOID10 starts
+        # with the GEOID10 of the unit they fall within
+        geo_w_pop = coords_w_pop.copy()
+        geo_w_pop[NAME[geo]] = geo_w_pop['GEOID10'].str[:PREFIX[geo]]
+        geo_w_pop[NAME[geo]] = geo_w_pop[NAME[geo]].where(geo_w_pop[NAME[geo]].isin(geo_shape['GEOID10']))
+
+    else:
+        # Merge geo that each block centroid falls within
+        geo_shape  = geo_shape[['GEOID10', 'geometry']].rename(columns={'GEOID10': NAME[geo]})
+        geo_w_pop = gpd.sjoin(coords_w_pop, geo_shape, how='left', predicate='intersects')
 
     geo_w_pop = geo_w_pop[~geo_w_pop[NAME[geo]].isna()].reset_index(drop=True)
     print('Converting block centroids to Albers...')
@@ -136,9 +147,7 @@ def calc_pop_weighted_centroids(coords_w_pop, geo_shape, geo):
 
     # return geo_w_pop
     print('Finding pop-weighted centroids...')
-    wm = lambda x: np.average(x, weights=geo_w_pop.loc[x.index, "POP"] + 1)
-    blocks_agg = geo_w_pop.groupby(NAME[geo]).agg(
-            {'Y': wm, 'X': wm, 'POP': 'sum'}).reset_index()
+    blocks_agg = aggregate_pop_weighted(geo_w_pop, NAME[geo])
 
     print('Saving zcta5 centroids to CSV...')
     blocks_agg_gdf = gpd.GeoDataFrame(blocks_agg, geometry=gpd.points_from_xy(
@@ -149,3 +158,36 @@ def calc_pop_weighted_centroids(coords_w_pop, geo_shape, geo):
     # blocks_agg_gdf['GEOID'] = blocks_agg_gdf['GEOID'].apply(lambda x: x[2:])
 
     return blocks_agg_gdf
+
+def aggregate_pop_weighted(blocks, by):
+    '''
+    Averages block coordinates within each unit, weighting every block by its
+    population plus one so that unpopulated units still get a centroid.
+
+    The weighted sums are computed from pre-multiplied columns with a single
+    groupby sum rather than one np.average call per unit.
+
+    Parameters
+    ----------
+    blocks : DataFrame
+        Block level X, Y and POP columns along with the unit each block is in
+    by : str
+        Name of the column holding the unit
+
+    Returns
+    -------
+    DataFrame with one row per unit holding the weighted Y and X and the summed
+    POP
+    '''
+    weights = blocks['POP'].to_numpy(dtype = float) + 1
+    weighted = pd.DataFrame({by  : blocks[by].to_numpy(),
+                             'Y' : blocks['Y'].to_numpy() * weights,
+                             'X' : blocks['X'].to_numpy() * weights,
+                             'W' : weights,
+                             'POP': blocks['POP'].to_numpy()})
+
+    sums = weighted.groupby(by).sum()
+    sums['Y'] = sums['Y'] / sums['W']
+    sums['X'] = sums['X'] / sums['W']
+
+    return sums[['Y', 'X', 'POP']].reset_index()
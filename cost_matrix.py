@@ -0,0 +1,160 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+SENTINEL = 999
+
+
+def factorize_labels(labels):
+    '''
+    Returns integer codes and the sorted unique labels.
+    '''
+    if isinstance(getattr(labels, 'dtype', None), pd.CategoricalDtype):
+        categorical = pd.Categorical(labels).remove_unused_categories()
+        if categorical.categories.is_monotonic_increasing and not (categorical.codes < 0).any():
+            return categorical.codes, pd.Index(np.asarray(categorical.categories))
+
+    return pd.factorize(np.asarray(labels), sort = True)
+
+
+class CostMatrix:
+    '''
+    Origin by destination matrix of travel minutes.
+
+    Origins and destinations are factorized to integer indices once and the
+    known minutes are held in a scipy.sparse CSR matrix, so pairs that were
+    never routed cost no memory. Explicitly stored entries are known minutes,
+    including zeros, and every other cell reads as the sentinel. A float32
+    dense array or the wide DataFrame layout of the transformed matrix csv are
+    only built when asked for.
+
+    Parameters
+    ----------
+    values : scipy.sparse.csr_matrix
+        Known minutes, one row per origin and one column per destination
+    origins : pandas.Index
+        Origin labels, in row order
+    destinations : pandas.Index
+        Destination labels, in column order
+    sentinel : float, default 999
+        Value of the pairs without known minutes
+    '''
+    def __init__(self, values, origins, destinations, sentinel=SENTINEL):
+        self.values = values.tocsr()
+        self.origins = pd.Index(origins)
+        self.destinations = pd.Index(destinations)
+        self.sentinel = sentinel
+
+    @classmethod
+    def from_long(cls, origin, destination, minutes, sentinel=SENTINEL):
+        '''
+        Builds a matrix from long-form origin, destination, minutes columns.
+        Origins and destinations are sorted, and pairs listed more than once
+        are averaged. Categorical columns, see utils.read_matrix, reuse their
+        codes instead of hashing every label.
+        '''
+        o_codes, origins = factorize_labels(origin)
+        d_codes, destinations = factorize_labels(destination)
+        minutes = np.asarray(minutes, dtype = np.float32)
+
+        pairs = o_codes.astype(np.int64) * len(destinations) + d_codes
+        if len(np.unique(pairs)) != len(pairs):
+            keys, inverse = np.unique(pairs, return_inverse = True)
+            minutes = (np.bincount(inverse, weights = minutes) / np.bincount(inverse)).astype(np.float32)
+            o_codes, d_codes = np.divmod(keys, len(destinations))
+
+        values = sp.csr_matrix((minutes, (o_codes, d_codes)), shape = (len(origins), len(destinations)))
+
+        return cls(values, origins, destinations, sentinel)
+
+    @classmethod
+    def from_parts(cls, parts_dir, sentinel=SENTINEL):
+        '''
+        Builds a matrix straight from the parts/subset_*.csv files written by
+        osrm_interface.get_durations.
+        '''
+        parts = sorted(glob.glob(os.path.join(parts_dir, 'subset_*.csv')))
+        matrix = pd.concat([pd.read_csv(part, header = None, names = ['origin', 'destination', 'minutes'],
+                                        dtype = {'origin': str, 'destination': str, 'minutes': np.float32})
+                            for part in parts], ignore_index = True)
+
+        return cls.from_long(matrix.origin, matrix.destination, matrix.minutes, sentinel)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def select_destinations(self, destinations, labels=None):
+        '''
+        Returns a matrix with the given destination columns, in the given
+        order. A destination may be selected more than once, e.g. for several
+        facilities in the same tract.
+
+        Parameters
+        ----------
+        destinations : list-like
+            Destination labels to select, all must be in the matrix
+        labels : list-like, optional
+            Labels of the selected columns, defaults to destinations
+        '''
+        columns = self.destinations.get_indexer(destinations)
+        assert (columns >= 0).all(), 'Some destinations are not in the matrix.'
+
+        return CostMatrix(self.values[:, columns], self.origins,
+                          destinations if labels is None else labels, self.sentinel)
+
+    def drop_empty_origins(self):
+        '''
+        Returns a matrix without the origins that have no known minutes.
+        '''
+        keep = np.flatnonzero(np.diff(self.values.indptr) > 0)
+        return CostMatrix(self.values[keep], self.origins[keep], self.destinations, self.sentinel)
+
+    def pad_origins(self, origins):
+        '''
+        Returns a matrix with rows of sentinels appended for the given origins
+        that are not already in it. Only the shape of the sparse matrix grows.
+        '''
+        missing = pd.Index(origins)
+        missing = missing[~missing.isin(self.origins)].unique()
+        values = self.values.copy()
+        values.resize((len(self.origins) + len(missing), len(self.destinations)))
+
+        return CostMatrix(values, self.origins.append(missing), self.destinations, self.sentinel)
+
+    def known(self):
+        '''
+        Returns a dense boolean array that is True for the cells with known
+        minutes.
+        '''
+        out = np.zeros(self.shape, dtype = bool)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.values.indptr))
+        out[rows, self.values.indices] = True
+
+        return out
+
+    def dense(self, dtype=np.float32):
+        '''
+        Returns the matrix as a dense array with the sentinel in every cell
+        without known minutes.
+        '''
+        out = np.full(self.shape, self.sentinel, dtype = dtype)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.values.indptr))
+        out[rows, self.values.indices] = self.values.data
+
+        return out
+
+    def to_frame(self):
+        '''
+        Returns the wide layout of the transformed matrix csv: an origin column
+        followed by one column per destination.
+        '''
+        frame = pd.DataFrame(self.dense(), columns = self.destinations)
+        frame.insert(0, 'origin', self.origins.astype(str))
+
+        return frame
+
+    def to_csv(self, path):
+        self.to_frame().to_csv(path, index = False)
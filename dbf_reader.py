@@ -0,0 +1,116 @@
+import struct
+import zipfile
+import numpy as np
+import pandas as pd
+
+
+def read_dbf_fields(buffer):
+    '''
+    Parses the header of a dBASE III file.
+
+    Parameters
+    ----------
+    buffer : bytes-like
+        Contents of the .dbf file, or at least its header
+
+    Returns
+    -------
+    Tuple of the number of records, the offset of the first record and a list
+    of (name, type, length, decimals) for each field
+    '''
+    n_records, header_length, record_length = struct.unpack('<IHH', bytes(buffer[4:12]))
+
+    fields = []
+    pos = 32
+    while buffer[pos] != 0x0D:
+        descriptor = bytes(buffer[pos:pos + 32])
+        name = descriptor[:11].split(b'\x00')[0].decode('ascii')
+        fields.append((name, chr(descriptor[11]), descriptor[16], descriptor[17]))
+        pos += 32
+
+    assert 1 + sum(field[2] for field in fields) == record_length, 'Unsupported DBF record layout.'
+
+    return n_records, header_length, fields
+
+
+def parse_column(raw, field_type, decimals, dtype=None, encoding='latin-1'):
+    '''
+    Converts an array of fixed-width field bytes into typed values.
+
+    Numeric fields become int64 when they have no decimals and no blanks, and
+    float64 otherwise. Character fields become strings unless dtype asks for a
+    number, e.g. float for the signed coordinate strings of TIGER files.
+    '''
+    raw = np.char.strip(raw)
+
+    if dtype is None and field_type in 'NF':
+        dtype = int if decimals == 0 else float
+
+    if dtype in (int, float):
+        blank = raw == b''
+        if blank.any():
+            values = np.full(len(raw), np.nan)
+            values[~blank] = raw[~blank].astype(float)
+            return values
+        return raw.astype(np.int64 if dtype is int else np.float64)
+
+    return pd.Series(raw).str.decode(encoding).to_numpy(dtype = object)
+
+
+def open_dbf(path):
+    '''
+    Returns the bytes of a .dbf file as a NumPy uint8 array.
+
+    Plain files are memory-mapped. Paths of the form
+    /vsizip/archive.zip/member.dbf, see utils.resource_path, are read
+    straight from the zip archive without extracting it to disk.
+    '''
+    if path.startswith('/vsizip/'):
+        zip_path, member = path[len('/vsizip/'):].split('.zip/', 1)
+        with zipfile.ZipFile(zip_path + '.zip') as archive:
+            return np.frombuffer(archive.read(member), dtype = np.uint8)
+
+    return np.memmap(path, dtype = np.uint8, mode = 'r')
+
+
+def read_dbf(path, fields=None, dtypes=None, encoding='latin-1'):
+    '''
+    Reads the requested columns of a .dbf file into a DataFrame.
+
+    The records are memory-mapped as a NumPy structured array, so only the
+    bytes of the requested fields are touched and every column is decoded
+    with vectorized operations instead of one record at a time.
+
+    Parameters
+    ----------
+    path : str
+        Path of the .dbf file, or of a .dbf inside a zip archive, see open_dbf
+    fields : list, optional
+        Names of the fields to read, defaults to all fields
+    dtypes : dict, optional
+        int, float or str keyed on field name, to override the type implied by
+        the field definition
+    encoding : str, default 'latin-1'
+        Encoding of the character fields
+
+    Returns
+    -------
+    DataFrame with one column per requested field, without deleted records
+    '''
+    dtypes = dtypes or {}
+    raw = open_dbf(path)
+    n_records, header_length, all_fields = read_dbf_fields(raw)
+
+    layout = np.dtype([('_deleted', 'S1')] + [(name, f'S{length}') for name, _, length, _ in all_fields])
+    records = raw[header_length:header_length + n_records * layout.itemsize].view(layout)
+
+    fields = fields or [field[0] for field in all_fields]
+    definitions = {field[0]: field for field in all_fields}
+    missing = set(fields) - set(definitions)
+    assert not missing, f'Fields {sorted(missing)} are not in {path}.'
+
+    keep = records['_deleted'] != b'*'
+
+    return pd.DataFrame({name: parse_column(records[name][keep], definitions[name][1], definitions[name][3],
+                                            dtypes.get(name), encoding)
+                         for name in fields})
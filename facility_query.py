@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+import spatial_access_prep
+
+
+class FacilityIndex:
+    '''
+    Answers nearest-facility questions for every origin of a cost matrix at
+    once.
+
+    The destinations of each origin are sorted by minutes a single time when
+    the index is built. Every query, for any resource category, then reads
+    from the same sorted order instead of sorting or scanning the matrix
+    again. Cells without known minutes, and the negative minutes written for
+    pairs OSRM could not route, count as unreachable.
+
+    Parameters
+    ----------
+    matrix : cost_matrix.CostMatrix
+        Origin by facility matrix, see
+        spatial_access_prep.create_transformed_matrix
+    categories : list-like, optional
+        Resource category of each destination column of matrix, e.g.
+        'methadone' or 'buprenorphine'
+    '''
+    def __init__(self, matrix, categories=None):
+        self.matrix = matrix
+        self.origins = matrix.origins
+        self.destinations = matrix.destinations
+        self.categories = None if categories is None else np.asarray(categories)
+
+        costs = matrix.dense()
+        costs[~matrix.known() | (costs < 0)] = np.inf
+
+        self.order = np.argsort(costs, axis = 1, kind = 'stable').astype(np.int32)
+        self.sorted_costs = np.take_along_axis(costs, self.order, axis = 1)
+
+    def mask(self, category=None):
+        '''
+        Returns a boolean array over the destination columns that is True for
+        the given category, or list of categories, and for all columns if
+        category is None.
+        '''
+        if category is None:
+            return np.ones(len(self.destinations), dtype = bool)
+
+        assert self.categories is not None, 'The index was built without categories.'
+        categories = [category] if isinstance(category, str) else list(category)
+
+        return np.isin(self.categories, categories)
+
+    def nearest_k(self, k=1, category=None):
+        '''
+        Finds the k closest reachable destinations of every origin.
+
+        Parameters
+        ----------
+        k : int, default 1
+            Number of destinations to return per origin
+        category : str or list, optional
+            Only consider destinations of these categories
+
+        Returns
+        -------
+        Tuple of two (origins, k) arrays: the destination labels, None where
+        an origin reaches fewer than k destinations, and their minutes, the
+        matrix sentinel where none was found
+        '''
+        selected = self.mask(category)[self.order] & np.isfinite(self.sorted_costs)
+        ranks = np.cumsum(selected, axis = 1)
+        rows, cols = np.nonzero(selected & (ranks <= k))
+        slots = ranks[rows, cols] - 1
+
+        labels = np.full((len(self.origins), k), None, dtype = object)
+        costs = np.full((len(self.origins), k), self.matrix.sentinel, dtype = np.float32)
+        labels[rows, slots] = np.asarray(self.destinations, dtype = object)[self.order[rows, cols]]
+        costs[rows, slots] = self.sorted_costs[rows, cols]
+
+        return labels, costs
+
+    def min_cost(self, category=None):
+        '''
+        Returns a Series of the minutes from every origin to its closest
+        reachable destination, the matrix sentinel if there is none.
+        '''
+        labels, costs = self.nearest_k(1, category)
+        return pd.Series(costs[:, 0], index = self.origins, name = 'minutes')
+
+    def count_within(self, threshold, category=None):
+        '''
+        Returns a Series of the number of destinations every origin reaches
+        within threshold minutes.
+        '''
+        within = self.mask(category)[self.order] & (self.sorted_costs <= threshold)
+        return pd.Series(within.sum(axis = 1), index = self.origins, name = 'count')
+
+    def summary(self, thresholds=(30, 60), categories=None):
+        '''
+        Returns a DataFrame with the minutes to the closest destination and
+        the number of destinations within each threshold, for every category.
+        '''
+        categories = categories if categories is not None else \
+            ([None] if self.categories is None else list(pd.unique(self.categories)))
+
+        columns = {}
+        for category in categories:
+            name = 'all' if category is None else category
+            columns[f'{name}_min_minutes'] = self.min_cost(category)
+            for threshold in thresholds:
+                columns[f'{name}_within_{threshold}'] = self.count_within(threshold, category)
+
+        return pd.DataFrame(columns)
+
+
+def build_facility_index(state_abbr, outpath, geo='tract'):
+    '''
+    Builds a FacilityIndex over every MOUD facility of a state, labelling each
+    facility with its category so one index serves all resource types.
+
+    Requires the destinations file for resource 'all', see
+    spatial_access_prep.create_destinations_file.
+    '''
+    dests_path = spatial_access_prep.destinations_file_path(state_abbr, outpath, 'all', geo)
+    destinations = pd.read_csv(dests_path, dtype={'GEOID':'str'})
+
+    matrix = spatial_access_prep.create_transformed_matrix(state_abbr, outpath, resource='all', geo=geo,
+                                                           as_frame=False)
+    categories = destinations.set_index('ID')['category'].reindex(matrix.destinations)
+
+    return FacilityIndex(matrix, categories.to_numpy())
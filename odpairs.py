@@ -1,8 +1,14 @@
-import geopandas as gpd
-import utils
 import os
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import utils
 
-def create_od_pairs(state_abbr, buffer, geo, outpath, o_feature = 'boundary', d_feature = 'centroid', centroid = 'centroid', replace = False):
+COLUMNS = ['origin', 'oX', 'oY', 'destination', 'dX', 'dY']
+
+def create_od_pairs(state_abbr, buffer, geo, outpath, o_feature = 'boundary', d_feature = 'centroid', centroid = 'centroid', replace = False,
+                    workers = None, chunk_prefix = 5):
     '''
     Creates origin destination pair mappings with the lat (Y), lon (X) coordinates
     of each geounits centroid.
@@ -24,45 +30,68 @@ def create_od_pairs(state_abbr, buffer, geo, outpath, o_feature = 'boundary', d_
     centroid : {'centroid', 'pwc'}
         Specifies whether the output centroid should be the boundary centroid
         or the population weighted centroid (pwc)
+    workers : int, optional
+        Number of worker processes. When given, origins are split into chunks
+        on the first chunk_prefix digits of their GEOID, e.g. by county, and
+        each chunk's pairs are appended to the csv as soon as it is done
+        instead of building the whole result in memory.
+    chunk_prefix : int, default 5
+        Number of leading GEOID digits origins are chunked on
 
     Returns
     -------
     A csv file containing the origin destination pairs for each geographical
     unit within the desired state along with the coordinates of the units
-    centroid.
+    centroid. The pairs are also returned as a DataFrame, or as the path of
+    the csv when they were written in chunks, so they are never all held in
+    memory.
+
+    For state_abbr 'us' the national file is both the origins and the
+    destinations.
     '''
     file_path = os.path.join(outpath, 'outputs', geo, state_abbr.upper(), f'{state_abbr.upper()}-odpairs-{buffer}m-{geo.upper()}.csv')
 
     if not os.path.isfile(file_path) or replace:
-        dl_dir, out_dir, file = utils.get_resource(state_abbr, geo, outpath)
-        origins = gpd.read_file(os.path.join(dl_dir, file))[['GEOID10', 'geometry']]
+        origins = utils.read_resource(state_abbr, geo, outpath, columns = ['GEOID10'])
         origins['oX'], origins['oY'] = create_xy_coords(gdf      = origins,
                                                         states   = state_abbr,
                                                         centroid = centroid,
                                                         geo      = geo,
                                                         outpath  = outpath)
 
-        border_states = utils.get_bordering_states(state_abbr, outpath)
-        destinations = utils.border_states_geodf(border_states, geo, outpath)[['GEOID10', 'geometry']].reset_index(drop=True)
-        destinations['dX'], destinations['dY'] = create_xy_coords(gdf      = destinations,
-                                                                  states   = border_states,
-                                                                  centroid = centroid,
-                                                                  geo      = geo,
-                                                                  outpath  = outpath)
+        if state_abbr.lower() == 'us':
+            destinations = origins.rename(columns = {'oX':'dX', 'oY':'dY'}).reset_index(drop=True)
+        else:
+            border_states = utils.get_bordering_states(state_abbr, outpath)
+            destinations = utils.border_states_geodf(border_states, geo, outpath, columns = ['GEOID10']).reset_index(drop=True)
+            destinations['dX'], destinations['dY'] = create_xy_coords(gdf      = destinations,
+                                                                      states   = border_states,
+                                                                      centroid = centroid,
+                                                                      geo      = geo,
+                                                                      outpath  = outpath)
 
         origins = origins.to_crs(epsg = 2163).rename(columns = {'GEOID10':'origin'})
         destinations = destinations.to_crs(epsg = 2163).rename(columns = {'GEOID10':'destination'})
 
         if o_feature == 'boundary':
-            origins['geometry'] = origins.copy().buffer(buffer)
+            origins['geometry'] = origins.buffer(buffer)
 
         elif o_feature == 'centroid':
-            origins['geometry'] = origins.copy().centroid.buffer(buffer)
+            origins['geometry'] = origins.centroid.buffer(buffer)
 
         elif d_feature == 'centroid':
-            destinations['geometry'] = destinations.copy().centroid
+            destinations['geometry'] = destinations.centroid
 
-        result = gpd.sjoin(origins, destinations, how = 'inner', op = 'intersects')[['origin', 'oX', 'oY', 'destination', 'dX', 'dY']].reset_index(drop=True)
+        if workers:
+            tmp_path = file_path + '.tmp'
+            pd.DataFrame(columns = COLUMNS).to_csv(tmp_path, index=False)
+            for chunk in iter_od_pair_chunks(origins, destinations, workers, chunk_prefix):
+                chunk.to_csv(tmp_path, index=False, header=False, mode='a')
+            os.replace(tmp_path, file_path)
+
+            return file_path
+
+        result = CandidateIndex(destinations).query(origins)
 
         result.to_csv(file_path, index=False)
 
@@ -71,6 +100,62 @@ def create_od_pairs(state_abbr, buffer, geo, outpath, o_feature = 'boundary', d_
     else:
         print(f'{os.path.abspath(file_path)} already exists.')
 
+def iter_od_pair_chunks(origins, destinations, workers, chunk_prefix = 5):
+    '''
+    Yields the origin destination pairs one chunk of origins at a time, in
+    GEOID order.
+
+    The chunks are queried in a process pool. Every worker builds the
+    destination index once, when it starts, and only the origins of a chunk
+    are sent with each task. At most two chunks per worker are in flight, so
+    memory stays bounded however many origins there are.
+
+    Parameters
+    ----------
+    origins : GeoDataFrame
+        Origins with origin, oX and oY columns and the geometry to search with
+    destinations : GeoDataFrame
+        Destinations with destination, dX and dY columns
+    workers : int
+        Number of worker processes, 1 queries the chunks in this process
+    chunk_prefix : int, default 5
+        Number of leading GEOID digits origins are chunked on
+    '''
+    if not len(origins):
+        return
+
+    origins = origins.sort_values('origin', kind = 'stable')
+    keys = origins['origin'].str[:chunk_prefix].to_numpy()
+    bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    chunks = (origins.iloc[start:stop] for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(origins)]))
+
+    if workers == 1:
+        index = CandidateIndex(destinations)
+        for chunk in chunks:
+            yield index.query(chunk)
+        return
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_candidate_index,
+                             initargs = (destinations,)) as executor:
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(executor.submit(_query_candidate_index, chunk))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+_CANDIDATE_INDEX = None
+
+def _init_candidate_index(destinations):
+    global _CANDIDATE_INDEX
+    _CANDIDATE_INDEX = CandidateIndex(destinations)
+
+def _query_candidate_index(origins):
+    return _CANDIDATE_INDEX.query(origins)
+
 def create_xy_coords(gdf, states, centroid, geo, outpath):
     '''
     '''
@@ -79,6 +164,55 @@ def create_xy_coords(gdf, states, centroid, geo, outpath):
         gdf = gdf.merge(pwc[['GEOID', 'X','Y']], how = 'left', left_on = 'GEOID10', right_on='GEOID')
 
     elif centroid == 'centroid':
-        gdf['X'], gdf['Y'] = gdf.centroid.x, gdf.centroid.y
+        centroids = gdf.centroid
+        gdf['X'], gdf['Y'] = centroids.x, centroids.y
 
     return gdf['X'], gdf['Y']
+
+
+class CandidateIndex:
+    '''
+    Spatial index over the destinations of a region, answering which
+    destinations every origin geometry intersects in one bulk query.
+
+    The STRtree is built once and can answer queries for any number of
+    batches of origins.
+
+    Parameters
+    ----------
+    destinations : GeoDataFrame
+        Destinations with destination, dX and dY columns, in the same CRS as
+        the origins that will be queried
+    '''
+    def __init__(self, destinations):
+        self.destinations = destinations.reset_index(drop=True)
+        self.sindex = self.destinations.sindex
+
+    def query_indices(self, geometries):
+        '''
+        Returns the positions of the intersecting (origin, destination) pairs,
+        sorted by origin and then destination.
+        '''
+        query_bulk = getattr(self.sindex, 'query_bulk', self.sindex.query)
+        o_idx, d_idx = query_bulk(geometries, predicate = 'intersects')
+
+        order = np.lexsort((d_idx, o_idx))
+        return o_idx[order], d_idx[order]
+
+    def query(self, origins):
+        '''
+        Returns a DataFrame of origin, oX, oY, destination, dX and dY for every
+        destination that intersects an origin geometry.
+
+        Parameters
+        ----------
+        origins : GeoDataFrame
+            Origins with origin, oX and oY columns and the geometry, e.g. the
+            buffered boundary, to search with
+        '''
+        o_idx, d_idx = self.query_indices(origins.geometry.values)
+
+        o_cols = origins[COLUMNS[:3]].iloc[o_idx].reset_index(drop=True)
+        d_cols = self.destinations[COLUMNS[3:]].iloc[d_idx].reset_index(drop=True)
+
+        return pd.concat([o_cols, d_cols], axis = 1)
@@ -2,9 +2,16 @@ import os
 import csv
 import json
 import time
+import random
 import requests
+import numpy as np
 import pandas as pd
-from collections import defaultdict
+import utils
+import osrm_package
+from operator import itemgetter
+from itertools import islice, groupby
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 def create_json_obj_dep(mappings):
     obj = {}
@@ -31,51 +38,240 @@ def create_json_obj_dep(mappings):
 
     return obj
 
+def create_json_obj_df(mappings):
+    '''
+    Builds the same OSRM input packages as create_json_obj_dep from an odpairs
+    DataFrame, using one sort of the rows by origin and slicing each origin's
+    rows out of the sorted arrays instead of filtering the DataFrame once per
+    origin.
+
+    Parameters
+    ----------
+    mappings : DataFrame
+        odpairs with origin, oX, oY, destination, dX and dY columns
+
+    Returns
+    -------
+    obj : dict
+        OSRM input packages keyed on origin GEOID
+    '''
+    codes, uniques = pd.factorize(mappings['origin'])
+    order = np.argsort(codes, kind = 'stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+
+    def to_str(column, zfill=0):
+        # Formats each distinct value once, coordinates repeat once per pair
+        col_codes, col_uniques = pd.factorize(mappings[column])
+        strings = np.array([str(x).zfill(zfill) for x in col_uniques], dtype = object)
+        return strings[col_codes[order]]
+
+    o_keys   = to_str('origin', 5)
+    d_keys   = to_str('destination', 5)
+    o_coords = to_str('oX') + ',' + to_str('oY')
+    d_coords = to_str('dX') + ',' + to_str('dY')
+    not_self = (mappings['destination'].to_numpy() != mappings['origin'].to_numpy())[order]
+
+    obj = {}
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        o_key = o_keys[start]
+        keep  = start + np.flatnonzero(not_self[start:end])
+
+        if len(keep) != 0:
+            obj[o_key] = {'destinations': [o_key] + d_keys[keep].tolist(),
+                          'coordinates' : [o_coords[keep[0]]] + d_coords[keep].tolist()}
+        else:
+            obj[o_key] = {'destinations': [o_key],
+                          'coordinates' : o_coords[start]}
+
+    return obj
+
+
+ZFILL = utils.GEOID_WIDTH
+
+
+def iter_odpairs_packages(csv_file, geo):
+    '''
+    Reads an odpairs csv one row at a time and yields the OSRM input package
+    of each run of consecutive rows sharing an origin.
+
+    Parameters
+    ----------
+    csv_file : str
+        Path of the odpairs csv created by odpairs.create_od_pairs
+    geo : {'tract', 'county', 'zip'}
+        String name of the boundary level used
+
+    Yields
+    ------
+    Tuple of the zero-filled origin GEOID and its package, a dict with
+    'destinations' and 'coordinates' lists
+    '''
+    width = ZFILL[geo.lower()]
+
+    with open(csv_file) as f:
+        reader = csv.reader(f)
+        next(reader)
+        for origin, rows in groupby(reader, key = itemgetter(0)):
+            package = {'destinations': [], 'coordinates': []}
+            for row in rows:
+                package['destinations'].append(row[3].zfill(width))
+                package['coordinates'].append(row[4] + ',' + row[5])
+
+            yield origin.zfill(width), package
+
+
 def create_json_obj(csv_file, geo):
     def def_val():
         return {'destinations':[],
                 'coordinates': []}
 
-    zfill = {'zip'   : 7,
-             'tract' : 11,
-             'county': 3}
-
     obj = defaultdict(def_val)
-    with open(csv_file) as f:
-        reader = csv.reader(f)
-        next(reader)
-        for row in reader:
-            origin = str(row[0]).zfill(zfill[geo.lower()])
-            obj[origin]['destinations'] = obj[origin]['destinations'] + [str(row[3]).zfill(zfill[geo.lower()])]
-            obj[origin]['coordinates'] = obj[origin]['coordinates'] + [row[4] + ',' + row[5]]
+    for origin, package in iter_odpairs_packages(csv_file, geo):
+        obj[origin]['destinations'].extend(package['destinations'])
+        obj[origin]['coordinates'].extend(package['coordinates'])
 
     return obj
 
-def prepare_osrm_inputs(state_abbr, geo, buffer, outpath):
+
+def write_json_obj(csv_file, geo, write_to):
+    '''
+    Writes the OSRM inputs for an odpairs csv to a json file one origin at a
+    time, so only a single origin's package is held in memory.
+
+    The odpairs csv written by odpairs.create_od_pairs keeps all rows of an
+    origin together. If an origin's rows turn out to be split up, the inputs
+    are built in memory with create_json_obj instead.
+
+    Parameters
+    ----------
+    csv_file : str
+        Path of the odpairs csv created by odpairs.create_od_pairs
+    geo : {'tract', 'county', 'zip'}
+        String name of the boundary level used
+    write_to : str
+        Path of the json file to write
+    '''
+    seen = set()
+
+    with open(write_to, 'w') as fp:
+        fp.write('{')
+        for origin, package in iter_odpairs_packages(csv_file, geo):
+            if origin in seen:
+                break
+
+            fp.write((', ' if seen else '') + json.dumps(origin) + ': ' + json.dumps(package))
+            seen.add(origin)
+        else:
+            fp.write('}')
+            return
+
+    print(f"Rows for {origin} are not contiguous, building OSRM inputs in memory...")
+    inputs = create_json_obj(csv_file, geo)
+    with open(write_to, 'w') as fp:
+        json.dump(inputs, fp)
+
+
+def prepare_osrm_inputs(state_abbr, geo, buffer, outpath, fmt='json'):
+    '''
+    Writes the OSRM input packages for every origin in the state's odpairs.
+
+    Parameters
+    ----------
+    state_abbr : str
+        Two letter abbreviation for state
+    geo : {'tract', 'county', 'zip'}
+        String name of the boundary level to use
+    buffer : int
+        Buffer in meters used to create the odpairs
+    outpath : str
+        Path of directory where output folder was created
+    fmt : {'json', 'npy'}, default 'json'
+        Write a single json file, or a directory of NumPy arrays that
+        get_durations memory-maps instead of parsing, see osrm_package
+    '''
     print(f"Preparing OSRM inputs for {state_abbr.upper()}...")
     state_path = os.path.join(outpath, 'outputs', geo, state_abbr.upper())
-    write_to = os.path.join(state_path, f'{state_abbr.upper()}_osrm_inputs.json')
+    write_to = osrm_inputs_path(state_path, state_abbr, fmt)
 
     odpairs_file_path = os.path.join(state_path, f'{state_abbr.upper()}-odpairs-{buffer}m-{geo.upper()}.csv')
 
     assert os.path.isfile(odpairs_file_path), f"odpairs file for {state_abbr.upper()} does not exist."
 
-    if not os.path.isfile(write_to):
-        inputs = create_json_obj(odpairs_file_path, geo)
-        print(f"Writing OSRM inputs for {state_abbr.upper()} to json file...")
-        with open(write_to, 'w') as fp:
-            json.dump(inputs, fp)
+    if not os.path.exists(write_to):
+        if fmt == 'npy':
+            print(f"Writing OSRM inputs for {state_abbr.upper()} to npy package...")
+            osrm_package.write_osrm_package(iter_odpairs_packages(odpairs_file_path, geo), write_to)
+        else:
+            print(f"Writing OSRM inputs for {state_abbr.upper()} to json file...")
+            write_json_obj(odpairs_file_path, geo, write_to + '.tmp')
+            os.replace(write_to + '.tmp', write_to)
         print(f"OSRM inputs for {state_abbr.upper()} complete!")
 
     else:
         print(f"OSRM inputs for {state_abbr.upper()} already exists!")
 
+
+def osrm_inputs_path(state_path, state_abbr, fmt='json'):
+    if fmt == 'npy':
+        return os.path.join(state_path, f'{state_abbr.upper()}_osrm_inputs')
+
+    return os.path.join(state_path, f'{state_abbr.upper()}_osrm_inputs.json')
+
+
+def load_osrm_inputs(state_path, state_abbr, fmt=None):
+    '''
+    Opens the state's OSRM inputs, memory-mapping the npy package or loading
+    the json file.
+
+    Parameters
+    ----------
+    state_path : str
+        Output directory of the state
+    state_abbr : str
+        Two letter abbreviation for state
+    fmt : {None, 'json', 'npy'}, default None
+        Format of the inputs to open, see prepare_osrm_inputs. By default the
+        most recently written of the two is opened.
+
+    Returns
+    -------
+    inputs : dict or OSRMPackage
+        OSRM input packages keyed on origin GEOID
+    '''
+    package_path = osrm_inputs_path(state_path, state_abbr, 'npy')
+    json_path = osrm_inputs_path(state_path, state_abbr, 'json')
+
+    if fmt is None:
+        written = {f: os.path.getmtime(path) for f, path in [('npy', os.path.join(package_path, 'offsets.npy')),
+                                                             ('json', json_path)]
+                   if os.path.isfile(path)}
+        assert written, f"osrm_inputs file for {state_abbr.upper()} does not exist."
+        fmt = max(written, key = written.get)
+
+    if fmt == 'npy':
+        assert os.path.isdir(package_path), f"osrm_inputs package for {state_abbr.upper()} does not exist."
+        return osrm_package.OSRMPackage(package_path)
+
+    assert fmt == 'json', f'Unknown OSRM inputs format {fmt}.'
+    assert os.path.isfile(json_path), f"osrm_inputs file for {state_abbr.upper()} does not exist."
+
+    with open(json_path) as fp:
+        return json.load(fp)
+
+
 def create_base_url(ip, port):
     base_url = 'http://' + str(ip) + ':' + str(port) + '/table/v1/driving/'
     return base_url
 
 
-def make_osrm_request(base_url, coordinates, sources=None, destinations=None):
+class OSRMError(Exception):
+    '''
+    Raised when the OSRM server does not return durations for a request.
+    '''
+    pass
+
+
+def send_osrm_request(base_url, coordinates, sources=None, destinations=None, session=None, timeout=None):
     request_url = base_url + ';'.join(coordinates)
     if sources:
         sources = [str(x) for x in sources]
@@ -85,19 +281,155 @@ def make_osrm_request(base_url, coordinates, sources=None, destinations=None):
         destinations = [str(x) for x in destinations]
         destinations = ';'.join(destinations)
 
+    session = session or requests
+
+    return session.get(request_url, params = {'sources': sources,
+                                              'destinations': destinations},
+                                    timeout = timeout)
+
+
+def make_osrm_request(base_url, coordinates, sources=None, destinations=None, session=None, timeout=None):
+    return send_osrm_request(base_url, coordinates, sources, destinations, session, timeout).text
+
+
+class OSRMClient:
+    '''
+    Sends table requests to one OSRM server over a pool of persistent
+    keep-alive connections.
+
+    A single client should be created per run and shared between threads so
+    that every request reuses an open connection instead of paying for a new
+    TCP handshake. Connection errors, timeouts and 5xx/429 responses are
+    retried with exponential backoff until the retries or the deadline run
+    out.
+
+    Parameters
+    ----------
+    base_url : str
+        OSRM table service url, see create_base_url
+    pool_size : int, default 10
+        Maximum number of open connections to the OSRM host, should be at
+        least the number of threads sending requests
+    timeout : float or tuple, default (5, 120)
+        Connect and read timeouts in seconds passed to requests
+    compress : bool, default True
+        Ask the server for gzip compressed responses
+    retries : int, default 4
+        Number of times a failed request is sent again
+    backoff : float, default 1
+        Seconds to wait before the first retry, doubled on every retry
+    deadline : float, optional
+        Seconds after which a request is given up on, including retries. The
+        timeouts of every attempt are capped at the time left.
+    '''
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url, pool_size=10, timeout=(5, 120), compress=True,
+                 retries=4, backoff=1, deadline=None):
+        self.base_url = base_url
+        self.profile = base_url.rstrip('/').split('/')[-1]
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1,
+                                                pool_maxsize = pool_size,
+                                                pool_block = True)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Connection'] = 'keep-alive'
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate' if compress else 'identity'
+
+    def request(self, coordinates, sources=None, destinations=None):
+        start = time.time()
+        attempt = 0
+
+        while True:
+            try:
+                response = send_osrm_request(self.base_url, coordinates, sources, destinations,
+                                             session = self.session, timeout = self.attempt_timeout(start))
+                if response.status_code not in self.RETRY_STATUS:
+                    return response.text
+                error = OSRMError(f'OSRM server returned {response.status_code}')
+
+            except requests.RequestException as e:
+                error = e
+
+            wait_for = self.backoff * 2 ** attempt * (0.5 + random.random())
+            out_of_time = self.deadline and time.time() - start + wait_for > self.deadline
+            if attempt >= self.retries or out_of_time:
+                raise OSRMError(f'Request failed after {attempt + 1} attempts: {error}') from error
+
+            time.sleep(wait_for)
+            attempt += 1
+
+    def attempt_timeout(self, start):
+        '''
+        Returns the timeouts of an attempt of a request started at start,
+        capped at the time left before the deadline.
+        '''
+        if not self.deadline:
+            return self.timeout
+
+        left = max(self.deadline - (time.time() - start), 0.001)
+        if isinstance(self.timeout, tuple):
+            return tuple(left if t is None else min(t, left) for t in self.timeout)
+
+        return left if self.timeout is None else min(self.timeout, left)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def extract_duration_rows(request_result, n_sources=1, n_destinations=None):
+    '''
+    Parses the durations table out of an OSRM table response.
+
+    Parameters
+    ----------
+    request_result : str
+        Body of the OSRM response
+    n_sources : int, default 1
+        Number of rows expected in the table
+    n_destinations : int, optional
+        Number of columns expected in every row
+
+    Returns
+    -------
+    rows : list
+        List of lists of durations in seconds, None where OSRM found no route
+
+    Raises
+    ------
+    OSRMError
+        If the response is not valid JSON, reports an error or its table does
+        not have the expected shape
+    '''
+    try:
+        result = json.loads(request_result)
+    except ValueError:
+        raise OSRMError(f'Invalid OSRM response: {request_result[:200]!r}')
 
-    return requests.get(request_url, params = {'sources': sources,
-                                               'destinations': destinations}).text
+    if result.get('code') != 'Ok' or 'durations' not in result:
+        raise OSRMError(f"OSRM error {result.get('code')}: {result.get('message', '')}")
 
+    rows = result['durations']
+    if len(rows) != n_sources or (n_destinations and any(len(row) != n_destinations for row in rows)):
+        raise OSRMError('OSRM durations table does not match the request.')
 
-def extract_durations(request_result):
-    result = json.loads(request_result)
-    try:
-        durations = result['durations'][0]
-    except:
-        durations = [0]
+    return rows
 
-    return durations
+
+def extract_durations(request_result):
+    return extract_duration_rows(request_result)[0]
 
 
 def results_to_df(origin, destinations, durations):
@@ -109,52 +441,377 @@ def results_to_df(origin, destinations, durations):
     return result[['origin', 'destination', 'minutes']]
 
 
-def get_durations(base_url, state_abbr, geo, buffer, outpath, num):
-    state_path = os.path.join(outpath, 'outputs', geo, state_abbr.upper())
-    osrm_inputs = os.path.join(state_path, f'{state_abbr.upper()}_osrm_inputs.json')
-
-    assert os.path.isfile(osrm_inputs), f"osrm_inputs file for {state_abbr.upper()} does not exist."
+def plan_batches(inputs, max_table_size=None):
+    '''
+    Groups origins into batches that can be sent as a single many-to-many
+    table request.
+
+    Origins are taken in GEOID order, so that neighbouring tracts, zips or
+    counties, which share most of their destinations, land in the same batch.
+    Origins are added to a batch while the union of their destinations fits
+    within max_table_size locations.
+
+    Parameters
+    ----------
+    inputs : dict
+        OSRM input packages keyed on origin GEOID
+    max_table_size : int, optional
+        Maximum number of locations the OSRM server accepts in a table
+        request (osrm-routed --max-table-size). If None every origin is sent
+        on its own.
+
+    Returns
+    -------
+    batches : list
+        List of lists of origin GEOIDs
+    '''
+    if not max_table_size:
+        return [[origin] for origin in inputs]
+
+    batches = []
+    batch = []
+    locations = set()
+
+    for origin in sorted(inputs):
+        dests = set(inputs[origin]['destinations'])
+        if batch and len(locations | dests) > max_table_size:
+            batches.append(batch)
+            batch = []
+            locations = set()
+
+        batch.append(origin)
+        locations |= dests
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def fetch_batch_durations(client, batch, inputs, cache=None):
+    '''
+    Requests the durations from every origin in the batch to all of its
+    destinations with a single table request, then splits the returned rows
+    back into one result per origin.
+
+    If a cache is given, pairs found in it are not requested again and every
+    pair returned by the server is added to it.
+
+    Parameters
+    ----------
+    client : OSRMClient
+        Client for the OSRM server
+    batch : list
+        Origin GEOIDs to request, see plan_batches
+    inputs : dict
+        OSRM input packages keyed on origin GEOID
+    cache : RouteCache, optional
+        Cache of durations between pairs of coordinates
+
+    Returns
+    -------
+    List of tuples of the origin, its destinations, the durations in seconds
+    and None for the error
+    '''
+    coords = {}
+    for origin in batch:
+        contents = inputs[origin]
+        coords.update(zip(contents['destinations'], contents['coordinates']))
+
+    pairs = {}
+    if cache is not None:
+        keys = {(origin, dest): cache.key(client.profile, coords[origin], coords[dest])
+                for origin in batch for dest in inputs[origin]['destinations']}
+        found = cache.get_many(set(keys.values()))
+        pairs = {pair: found[key] for pair, key in keys.items() if key in found}
+
+    index = {}
+    coordinates = []
+    sources = []
+    destinations = {}
+    for origin in batch:
+        missing = [dest for dest in inputs[origin]['destinations'] if (origin, dest) not in pairs]
+        if not missing:
+            continue
+
+        sources.append(origin)
+        destinations.update(dict.fromkeys(missing))
+        for dest in missing + [origin]:
+            if dest not in index:
+                index[dest] = len(coordinates)
+                coordinates.append(coords[dest])
 
+    if sources:
+        destinations = list(destinations)
+        dest_ids = [index[dest] for dest in destinations]
+        req = client.request(coordinates = coordinates,
+                             sources = [index[origin] for origin in sources],
+                             destinations = dest_ids if dest_ids != list(range(len(coordinates))) else None)
+        rows = extract_duration_rows(req, len(sources), len(destinations))
+
+        new_pairs = {}
+        for origin, row in zip(sources, rows):
+            new_pairs.update(zip(((origin, dest) for dest in destinations), row))
+        pairs.update(new_pairs)
+
+        if cache is not None:
+            cache.put_many({cache.key(client.profile, coords[o], coords[d]): seconds
+                            for (o, d), seconds in new_pairs.items()})
+
+    results = []
+    for origin in batch:
+        dests = inputs[origin]['destinations']
+        results.append((origin, dests, [pairs[(origin, dest)] for dest in dests], None))
+
+    return results
+
+
+def fetch_durations(client, batch, inputs, cache=None):
+    '''
+    Requests the durations of a batch, see fetch_batch_durations. If a batch
+    of several origins fails, its origins are requested one at a time, so a
+    single origin the server rejects, e.g. with NoSegment, does not fail its
+    neighbours on every rerun.
+
+    Returns
+    -------
+    List of tuples of the origin, its destinations, the durations in seconds
+    and the error. If the request for an origin failed, durations is None and
+    error holds the exception.
+    '''
+    try:
+        return fetch_batch_durations(client, batch, inputs, cache)
+    except (OSRMError, requests.RequestException) as e:
+        if len(batch) == 1:
+            raise
+        print(f'Batch of {len(batch)} origins failed ({e}), retrying them one at a time.')
+
+    results = []
+    for origin in batch:
+        try:
+            results.extend(fetch_batch_durations(client, [origin], inputs, cache))
+        except (OSRMError, requests.RequestException) as e:
+            results.append((origin, inputs[origin]['destinations'], None, e))
+
+    return results
+
+
+def iter_durations(client, inputs, workers=8, max_in_flight=None, ordered=False, max_table_size=None,
+                   cache=None):
+    '''
+    Requests durations for every origin in inputs using a pool of threads and
+    yields the results as they arrive.
+
+    No more than max_in_flight requests are submitted at a time, so the next
+    request is only sent once a previous result has been consumed.
+
+    Parameters
+    ----------
+    client : OSRMClient
+        Client for the OSRM server, its pool_size should be at least workers
+    inputs : dict
+        OSRM input packages keyed on origin GEOID
+    workers : int, default 8
+        Number of threads sending requests to the OSRM server
+    max_in_flight : int, optional
+        Maximum number of requests submitted but not yet consumed, defaults
+        to twice the number of workers
+    ordered : bool, default False
+        Yield results in batch order instead of completion order
+    max_table_size : int, optional
+        Batch neighbouring origins into requests of up to this many
+        locations, see plan_batches
+    cache : RouteCache, optional
+        Cache consulted before requesting durations from the server
+
+    Yields
+    ------
+    Tuple of the origin, its destinations, the durations in seconds and the
+    error. If the request for an origin failed, durations is None and error
+    holds the exception.
+    '''
+    max_in_flight = max_in_flight or 2 * workers
+    batches = iter(plan_batches(inputs, max_table_size))
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        pending = deque()
+
+        def submit(n):
+            for batch in islice(batches, n):
+                future = executor.submit(fetch_durations, client, batch, inputs, cache)
+                future.batch = batch
+                pending.append(future)
+
+        submit(max_in_flight)
+
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+
+            try:
+                yield from future.result()
+            except (OSRMError, requests.RequestException) as e:
+                for origin in future.batch:
+                    yield origin, inputs[origin]['destinations'], None, e
+
+            submit(1)
+
+
+def write_part(parts_path, origin, destinations, durations):
+    part_path = os.path.join(parts_path, f'subset_{origin}.csv')
+    with open(part_path + '.tmp', 'w') as csvfile:
+        csvwriter = csv.writer(csvfile)
+
+        for i, dest in enumerate(destinations):
+            if type(durations[i]) not in [int, float]:
+                durations[i] = -60000
+            csvwriter.writerow([origin, dest, round(durations[i] / 60, 2)])
+
+    os.replace(part_path + '.tmp', part_path)
+
+
+package_digest = osrm_package.package_digest
+
+
+def read_manifest(parts_path):
+    '''
+    Reads the manifest of completed origins in parts_path.
+
+    Returns
+    -------
+    manifest : dict
+        Digest of the input package each origin was last completed with,
+        keyed on origin GEOID
+    '''
+    manifest = {}
+    manifest_path = os.path.join(parts_path, 'manifest.csv')
+
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            for row in csv.reader(f):
+                if len(row) == 2:
+                    manifest[row[0]] = row[1]
+
+    return manifest
+
+
+def log_completed_origin(parts_path, origin, digest):
+    with open(os.path.join(parts_path, 'manifest.csv'), 'a') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow([origin, digest])
+
+
+def log_failed_origin(parts_path, origin, error):
+    with open(os.path.join(parts_path, 'failed_origins.csv'), 'a') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow([origin, time.strftime('%Y-%m-%d %H:%M:%S'), str(error)])
+
+
+def get_durations(base_url, state_abbr, geo, buffer, outpath, num, workers=1, max_in_flight=None,
+                  max_table_size=None, resume=True, retries=4, deadline=None, cache=None, fmt=None):
+    '''
+    Requests the durations from every origin in the state's OSRM inputs to
+    its destinations and writes them to parts/subset_{origin}.csv.
+
+    Every completed origin is appended to parts/manifest.csv along with a hash
+    of its input package. When resuming, origins that are in the manifest with
+    an unchanged package are skipped, so only new, changed, failed or missing
+    origins are requested again. Origins whose request still fails after
+    retrying are not written but are appended to parts/failed_origins.csv.
+
+    Parameters
+    ----------
+    base_url : str
+        OSRM table service url, see create_base_url
+    state_abbr : str
+        Two letter abbreviation for state
+    geo : {'tract', 'county', 'zip'}
+        String name of the boundary level to use
+    buffer : int
+        Buffer in meters used to create the odpairs
+    outpath : str
+        Path of directory where output folder was created
+    num : int
+        Label for this run in the progress messages
+    workers : int, default 1
+        Number of threads sending requests to the OSRM server
+    max_in_flight : int, optional
+        Maximum number of requests submitted but not yet written
+    max_table_size : int, optional
+        Batch neighbouring origins into requests of up to this many
+        locations, see plan_batches
+    resume : bool, default True
+        Skip origins completed by a previous run with the same input package
+    retries : int, default 4
+        Number of times a failed request is sent again
+    deadline : float, optional
+        Seconds after which a request is given up on, including retries
+    cache : RouteCache, optional
+        Cache consulted before requesting durations from the server, only the
+        pairs missing from it are requested
+    fmt : {None, 'json', 'npy'}, default None
+        Format of the OSRM inputs to read, defaults to the most recently
+        written, see load_osrm_inputs
+    '''
+    state_path = os.path.join(outpath, 'outputs', geo, state_abbr.upper())
     parts_path = os.path.join(state_path, 'parts')
 
     if not os.path.isdir(parts_path):
         os.makedirs(parts_path)
 
-    inputs = json.load(open(osrm_inputs))
+    inputs = load_osrm_inputs(state_path, state_abbr, fmt)
 
-    count = 0
-    total = len(inputs)
-
-    for origin, contents in inputs.items():
-        print(f'Working on {origin}...')
-        id = contents['destinations'].index(origin)
-        print(origin, id)
-        req = make_osrm_request(base_url, coordinates = contents['coordinates'],
-                                          sources = [id])
-
-        durations = extract_durations(req)
+    digests = {origin: package_digest(contents) for origin, contents in inputs.items()}
 
-        # df = results_to_df(origin, destinations = contents['destinations'],
-        #                            durations = durations)
+    if resume:
+        manifest = read_manifest(parts_path)
+        written = set(os.listdir(parts_path))
+        todo = [origin for origin in inputs
+                if manifest.get(origin) != digests[origin] or f'subset_{origin}.csv' not in written]
+        inputs = get_packages_subset(todo, inputs)
+        print(f'Resuming {state_abbr.upper()}: {len(inputs)} of {len(digests)} origins left to request.')
 
-        # df.to_csv(os.path.join(out_dir, f'matrix_subset_{origin}.csv'), index = False)
+    count = 0
+    failed = 0
+    total = len(inputs)
+    start = time.time()
 
-        with open(os.path.join(parts_path, f'subset_{origin}.csv'), 'w') as csvfile:
-            csvwriter = csv.writer(csvfile)
+    with OSRMClient(base_url, pool_size = workers, retries = retries, deadline = deadline) as client:
+        for origin, destinations, durations, error in iter_durations(client, inputs, workers, max_in_flight,
+                                                                      max_table_size = max_table_size,
+                                                                      cache = cache):
+            if error is None:
+                write_part(parts_path, origin, destinations, durations)
+                log_completed_origin(parts_path, origin, digests[origin])
+            else:
+                print(f'Failed on {origin}: {error}')
+                log_failed_origin(parts_path, origin, error)
+                failed += 1
 
-            for i, dest in enumerate(contents['destinations']):
-                if type(durations[i]) not in [int, float]:
-                    durations[i] = -60000
-                csvwriter.writerow([origin, dest, round(durations[i] / 60, 2)])
+            count += 1
+            print(f'Number {num}: {count} of {total} completed for {state_abbr.upper()}')
 
-        print(f'Number {num}: {count} of {total} completed for {state_abbr.upper()}')
-        count += 1
+    elapsed = time.time() - start
+    print(f'{state_abbr.upper()}: {total} origins in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.1f} origins/s)')
 
-        # time.sleep(5)
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Route cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.1%} hit rate), {stats['size']} pairs cached")
 
+    if failed:
+        print(f'{failed} origins failed for {state_abbr.upper()}, see {os.path.join(parts_path, "failed_origins.csv")}. '
+              'Run again to retry them.')
 
 
 def get_packages_subset(subset_ids, packages):
+    if isinstance(packages, osrm_package.OSRMPackage):
+        return packages.subset([str(id) for id in subset_ids])
+
     subset = {}
     for id in subset_ids:
         subset[id] = packages[str(id)]
@@ -0,0 +1,156 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from array import array
+
+FILES = ['origins', 'offsets', 'destinations', 'lon', 'lat']
+
+
+def package_digest(contents):
+    '''
+    Returns a hash of an origin's OSRM input package, which changes whenever
+    its destinations or their coordinates change.
+
+    Coordinates are hashed as the repr of their floats, so the json and npy
+    formats of the same package have the same digest and a manifest stays
+    valid when the format of the inputs changes.
+    '''
+    coordinates = []
+    for coord in contents['coordinates']:
+        x, y = coord.split(',')
+        coordinates.append(f'{float(x)!r},{float(y)!r}')
+
+    package = json.dumps([contents['destinations'], coordinates], separators = (',', ':'))
+    return hashlib.sha1(package.encode()).hexdigest()
+
+
+def write_osrm_package(packages, write_to):
+    '''
+    Writes OSRM input packages to a directory of NumPy arrays that can be
+    memory-mapped by OSRMPackage.
+
+    The directory holds the origin GEOIDs, an offsets array marking where each
+    origin's rows start, and the destination GEOIDs, longitudes and latitudes
+    of all rows. Packages yielded more than once for the same origin are
+    merged, keeping the order their rows were yielded in.
+
+    Parameters
+    ----------
+    packages : iterable
+        Tuples of origin GEOID and package, a dict with 'destinations' and
+        'coordinates' lists, see osrm_interface.iter_odpairs_packages
+    write_to : str
+        Path of the directory to create
+    '''
+    run_origins = []
+    run_counts = array('q')
+    destinations = []
+    lon = array('d')
+    lat = array('d')
+
+    for origin, package in packages:
+        run_origins.append(origin)
+        run_counts.append(len(package['destinations']))
+        destinations.extend(package['destinations'])
+        for coord in package['coordinates']:
+            x, y = coord.split(',')
+            lon.append(float(x))
+            lat.append(float(y))
+
+    codes, origins = pd.factorize(pd.Series(run_origins, dtype = object))
+    run_counts = np.frombuffer(run_counts, dtype = np.int64)
+    destinations = np.array(destinations, dtype = bytes)
+    lon = np.frombuffer(lon, dtype = np.float64)
+    lat = np.frombuffer(lat, dtype = np.float64)
+
+    if len(origins) != len(run_origins):
+        order = np.argsort(np.repeat(codes, run_counts), kind = 'stable')
+        destinations, lon, lat = destinations[order], lon[order], lat[order]
+
+    counts = np.bincount(codes, weights = run_counts, minlength = len(origins)).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    tmp_dir = write_to + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors = True)
+    os.makedirs(tmp_dir)
+
+    arrays = {'origins': np.array(list(origins), dtype = bytes),
+              'offsets': offsets,
+              'destinations': destinations,
+              'lon': lon,
+              'lat': lat}
+    for name in FILES:
+        np.save(os.path.join(tmp_dir, name + '.npy'), arrays[name])
+
+    shutil.rmtree(write_to, ignore_errors = True)
+    os.replace(tmp_dir, write_to)
+
+
+class OSRMPackage:
+    '''
+    Read-only mapping of origin GEOID to OSRM input package, backed by the
+    memory-mapped arrays written by write_osrm_package.
+
+    Opening a package only reads the origin GEOIDs. A package's destinations
+    and coordinates are read from disk when it is looked up, so workers never
+    have to parse the inputs of the whole state.
+
+    Parameters
+    ----------
+    path : str
+        Directory written by write_osrm_package
+    origins : list, optional
+        Restrict the mapping to these origin GEOIDs
+    '''
+    def __init__(self, path, origins=None, _arrays=None):
+        self.path = path
+        self.arrays = _arrays or {name: np.load(os.path.join(path, name + '.npy'), mmap_mode = 'r')
+                                  for name in FILES}
+        self.index = {origin.decode(): i for i, origin in enumerate(self.arrays['origins'])}
+
+        if origins is not None:
+            self.index = {origin: self.index[origin] for origin in origins}
+
+    def subset(self, origins):
+        '''
+        Returns a package restricted to the given origins, sharing the same
+        memory-mapped arrays.
+        '''
+        return OSRMPackage(self.path, origins, self.arrays)
+
+    def rows(self, origin):
+        i = self.index[origin]
+        return slice(self.arrays['offsets'][i], self.arrays['offsets'][i + 1])
+
+    def digest(self, origin):
+        '''
+        Returns a hash of the origin's destinations and coordinates, see
+        package_digest.
+        '''
+        return package_digest(self[origin])
+
+    def __getitem__(self, origin):
+        rows = self.rows(origin)
+        lon = self.arrays['lon'][rows].tolist()
+        lat = self.arrays['lat'][rows].tolist()
+
+        return {'destinations': [d.decode() for d in self.arrays['destinations'][rows]],
+                'coordinates' : [f'{x!r},{y!r}' for x, y in zip(lon, lat)]}
+
+    def __contains__(self, origin):
+        return origin in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def items(self):
+        return ((origin, self[origin]) for origin in self.index)
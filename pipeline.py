@@ -0,0 +1,187 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import utils
+import odpairs
+import centroids
+import osrm_interface
+
+STAGES = ['odpairs', 'osrm_inputs', 'durations', 'aggregate']
+
+
+def build_tasks(states, geo, buffer, outpath, base_url=None, centroid='centroid', stages=STAGES,
+                osrm_fmt='json', osrm_kwargs=None):
+    '''
+    Builds the dependency graph of pipeline stages for a list of states.
+
+    Downloads and centroids are shared between states: a bordering state's
+    shapefile or population weighted centroids are a single task that every
+    state in its region depends on.
+
+    Parameters
+    ----------
+    states : list
+        Two letter abbreviations of the states to run
+    geo : {'tract', 'county', 'zip'}
+        String name of the boundary level to use
+    buffer : int
+        Number of meters of the buffer to be applied to origins
+    outpath : str
+        Path of directory where output folders should be created
+    base_url : str, optional
+        OSRM table service url, see osrm_interface.create_base_url. Required
+        for the durations stage.
+    centroid : {'centroid', 'pwc'}, default 'centroid'
+        Use boundary centroids or population weighted centroids
+    stages : list
+        Stages to run for every state, any of 'odpairs', 'osrm_inputs',
+        'durations' and 'aggregate'
+    osrm_fmt : {'json', 'npy'}, default 'json'
+        Format of the OSRM inputs, see osrm_interface.prepare_osrm_inputs.
+        When the osrm_inputs stage is not run, the durations stage reads the
+        most recently written inputs.
+    osrm_kwargs : dict, optional
+        Extra keyword arguments for osrm_interface.get_durations
+
+    Returns
+    -------
+    tasks : dict
+        (function, args, kwargs, dependencies) keyed on task name
+    '''
+    assert 'durations' not in stages or base_url, 'base_url is required to get durations.'
+    osrm_kwargs = osrm_kwargs or {}
+
+    tasks = {}
+    regions = {state: utils.get_bordering_states(state, outpath) for state in states}
+    region_states = sorted({s for region in regions.values() for s in region} | set(states))
+
+    for s in region_states:
+        geo_types = [geo, 'block', 'block_pop'] if centroid == 'pwc' else [geo]
+        for geo_type in geo_types:
+            tasks[('resource', s, geo_type)] = (utils.get_resource, (s, geo_type, outpath), {}, [])
+
+        if centroid == 'pwc':
+            tasks[('centroids', s)] = (centroids.compute_geo_centroids, (s, geo, outpath), {},
+                                       [('resource', s, geo_type) for geo_type in geo_types])
+
+    for state in states:
+        region = sorted(set(regions[state]) | {state})
+        deps = [('resource', s, geo) for s in region]
+        if centroid == 'pwc':
+            deps += [('centroids', s) for s in region]
+
+        stage_tasks = {'odpairs'    : (odpairs.create_od_pairs, (state, buffer, geo, outpath),
+                                       {'centroid': centroid}),
+                       'osrm_inputs': (osrm_interface.prepare_osrm_inputs, (state, geo, buffer, outpath),
+                                       {'fmt': osrm_fmt}),
+                       'durations'  : (osrm_interface.get_durations, (base_url, state, geo, buffer, outpath, state),
+                                       {'fmt': osrm_fmt if 'osrm_inputs' in stages else None, **osrm_kwargs}),
+                       'aggregate'  : (utils.aggregate_parts, (state, geo, outpath), {})}
+
+        for stage in STAGES:
+            if stage in stages:
+                func, args, kwargs = stage_tasks[stage]
+                tasks[(stage, state)] = (func, args, kwargs, deps)
+                deps = [(stage, state)]
+
+    return tasks
+
+
+def run_tasks(tasks, workers=None):
+    '''
+    Runs tasks in a process pool as soon as all of their dependencies have
+    finished. Tasks depending on a failed task are skipped.
+
+    Parameters
+    ----------
+    tasks : dict
+        (function, args, kwargs, dependencies) keyed on task name, see
+        build_tasks
+    workers : int, optional
+        Number of worker processes, defaults to the number of CPUs
+
+    Returns
+    -------
+    failed : dict
+        Exception raised by each failed task, or None for skipped tasks, keyed
+        on task name
+    '''
+    done = set()
+    failed = {}
+    waiting = dict(tasks)
+    running = {}
+
+    with ProcessPoolExecutor(max_workers = workers or os.cpu_count()) as executor:
+        while waiting or running:
+            for name, (func, args, kwargs, deps) in list(waiting.items()):
+                if any(dep in failed for dep in deps):
+                    print(f'Skipping {name}, a task it depends on failed.')
+                    failed[name] = None
+                    del waiting[name]
+
+                elif all(dep in done for dep in deps):
+                    running[executor.submit(func, *args, **kwargs)] = name
+                    del waiting[name]
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as e:
+                    print(f'{name} failed: {e!r}')
+                    failed[name] = e
+
+    return failed
+
+
+def run_states(states, geo, buffer, outpath, base_url=None, centroid='centroid', stages=STAGES,
+               workers=None, osrm_fmt='json', osrm_kwargs=None):
+    '''
+    Runs the pipeline for several states at once, running independent states
+    and stages in parallel in a process pool.
+
+    Parameters
+    ----------
+    states : list
+        Two letter abbreviations of the states to run
+    geo : {'tract', 'county', 'zip'}
+        String name of the boundary level to use
+    buffer : int
+        Number of meters of the buffer to be applied to origins
+    outpath : str
+        Path of directory where output folders should be created
+    base_url : str, optional
+        OSRM table service url, required for the durations stage
+    centroid : {'centroid', 'pwc'}, default 'centroid'
+        Use boundary centroids or population weighted centroids
+    stages : list
+        Stages to run for every state, any of 'odpairs', 'osrm_inputs',
+        'durations' and 'aggregate'
+    workers : int, optional
+        Number of worker processes, defaults to the number of CPUs
+    osrm_fmt : {'json', 'npy'}, default 'json'
+        Format of the OSRM inputs
+    osrm_kwargs : dict, optional
+        Extra keyword arguments for osrm_interface.get_durations
+
+    Returns
+    -------
+    failed : dict
+        Exception raised by each failed task keyed on task name
+    '''
+    states = [state.lower() for state in states]
+    tasks = build_tasks(states, geo, buffer, outpath, base_url, centroid, stages, osrm_fmt, osrm_kwargs)
+
+    print(f'Running {len(tasks)} tasks for {len(states)} states...')
+    failed = run_tasks(tasks, workers)
+
+    if failed:
+        print(f'{len(failed)} tasks failed or were skipped.')
+    else:
+        print('All states complete!')
+
+    return failed
@@ -0,0 +1,125 @@
+import sqlite3
+import threading
+
+
+class RouteCache:
+    '''
+    On-disk cache of OSRM durations between pairs of locations, stored in a
+    SQLite file.
+
+    Entries are keyed on the OSRM profile and the origin and destination
+    coordinates rounded to `precision` decimal places, so the same pair is
+    only routed once across overlapping regions and across reruns. When the
+    cache grows past max_entries the least recently used entries are evicted.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file, created if it does not exist
+    max_entries : int, default 50000000
+        Maximum number of pairs kept in the cache
+    precision : int, default 5
+        Number of decimal places coordinates are rounded to, 5 is about a meter
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups answered from the cache
+    misses : int
+        Number of lookups not found in the cache
+    '''
+    CHUNK = 500
+
+    def __init__(self, path, max_entries=50000000, precision=5):
+        self.path = path
+        self.max_entries = max_entries
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread = False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS routes (
+                                 key TEXT PRIMARY KEY,
+                                 seconds REAL,
+                                 last_used INTEGER NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS routes_last_used ON routes (last_used)')
+        self.conn.commit()
+
+        self.tick = self.conn.execute('SELECT COALESCE(MAX(last_used), 0) FROM routes').fetchone()[0]
+        self.size = self.conn.execute('SELECT COUNT(*) FROM routes').fetchone()[0]
+
+    def key(self, profile, origin, destination):
+        '''
+        Returns the cache key for a pair of 'lon,lat' coordinate strings.
+        '''
+        o = ','.join(f'{float(x):.{self.precision}f}' for x in origin.split(','))
+        d = ','.join(f'{float(x):.{self.precision}f}' for x in destination.split(','))
+        return f'{profile}|{o}|{d}'
+
+    def get_many(self, keys):
+        '''
+        Looks up several keys at once.
+
+        Returns
+        -------
+        found : dict
+            Durations in seconds keyed on cache key, for the keys in the cache.
+            A duration is None if OSRM found no route for the pair.
+        '''
+        keys = list(keys)
+        found = {}
+
+        with self.lock:
+            self.tick += 1
+            for i in range(0, len(keys), self.CHUNK):
+                chunk = keys[i:i + self.CHUNK]
+                marks = ','.join('?' * len(chunk))
+                found.update(self.conn.execute(f'SELECT key, seconds FROM routes WHERE key IN ({marks})', chunk))
+                self.conn.execute(f'UPDATE routes SET last_used = ? WHERE key IN ({marks})', [self.tick] + chunk)
+            self.conn.commit()
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    def put_many(self, items):
+        '''
+        Stores durations in seconds keyed on cache key, keeping the existing
+        duration for keys already cached, then evicts the least recently used
+        entries if the cache is over max_entries.
+        '''
+        items = list(items.items()) if isinstance(items, dict) else list(items)
+
+        with self.lock:
+            self.tick += 1
+            before = self.conn.total_changes
+            self.conn.executemany('INSERT OR IGNORE INTO routes (key, seconds, last_used) VALUES (?, ?, ?)',
+                                  [(k, v, self.tick) for k, v in items])
+            self.size += self.conn.total_changes - before
+
+            if self.size > self.max_entries:
+                self.conn.execute('''DELETE FROM routes WHERE key IN (
+                                         SELECT key FROM routes ORDER BY last_used LIMIT ?)''',
+                                  (self.size - self.max_entries,))
+                self.size = self.max_entries
+            self.conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': self.size}
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
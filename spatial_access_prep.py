@@ -1,8 +1,12 @@
+import io
 import os
 import utils
+import cost_matrix
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
+RESOURCES = ['methadone', 'naltrexone/vivitrol', 'buprenorphine', 'STU']
 
 
 def create_destinations_file(state_abbr, moud_file, outpath, resource='all', geo='tract', parts=None, save=False):
@@ -27,14 +31,12 @@ def create_destinations_file(state_abbr, moud_file, outpath, resource='all', geo
     Returns
     -------
     '''
-    assert resource in ['methadone', 'naltrexone/vivitrol', 'buprenorphine', 'STU', 'all'], "Not a valid resource type."
+    assert resource in RESOURCES + ['all'], "Not a valid resource type."
 
     bordering_states = utils.get_bordering_states(state_abbr, outpath)
-    regional_shp = utils.border_states_geodf(bordering_states, geo, outpath)
+    regional_shp = utils.border_states_geodf(bordering_states, geo, outpath, columns = ['GEOID10'], crs = 4326)
 
-    raw_matrix_file_name = f'{state_abbr}-matrix-TRACT.csv'
-    raw_matrix_file_path = os.path.join(outpath, 'outputs', geo, state_abbr, raw_matrix_file_name)
-    raw_matrix = pd.read_csv(raw_matrix_file_path, dtype={'destination':'str'})
+    raw_destinations = read_raw_matrix(state_abbr, outpath, geo, columns=['destination']).destination.cat.categories
 
     mouds_shp = gpd.read_file(moud_file)
 
@@ -42,42 +44,232 @@ def create_destinations_file(state_abbr, moud_file, outpath, resource='all', geo
         mouds_shp = mouds_shp[mouds_shp['category'] == resource]
 
 
-    regional_shp.geometry = regional_shp.geometry.to_crs(epsg = 4326)
     mouds_shp.geometry = mouds_shp.geometry.to_crs(epsg = 4326)
 
-    destinations = (gpd.sjoin(mouds_shp, regional_shp[['GEOID10', 'geometry']], how='inner', op='intersects')
+    destinations = (gpd.sjoin(mouds_shp, regional_shp[['GEOID10', 'geometry']], how='inner', predicate='intersects')
                     .rename(columns={'GEOID10':'GEOID'})
                     .drop('index_right', axis = 1)
                     )
 
-    destinations = destinations[destinations['GEOID'].isin(raw_matrix.destination)]
+    destinations = number_destinations(destinations[destinations['GEOID'].isin(raw_destinations)])
+
+    if save:
+        save_destinations(destinations, destinations_file_path(state_abbr, outpath, resource, geo))
+        return None
+
+    return destinations
+
+def read_raw_matrix(state_abbr, outpath, geo='tract', columns=None, destinations=None):
+    '''
+    Reads the raw tract matrix of a state with categorical GEOIDs and float32
+    minutes, from its npy or parquet sidecar when aggregate_parts wrote one.
+    See utils.read_matrix.
+    '''
+    raw_matrix_file_name = f'{state_abbr}-matrix-TRACT.csv'
+    raw_matrix_file_path = os.path.join(outpath, 'outputs', geo, state_abbr, raw_matrix_file_name)
+
+    return utils.read_matrix(raw_matrix_file_path, 'tract', columns, destinations)
 
-    destinations.reset_index(drop=True, inplace=True)
+def number_destinations(destinations):
+    '''
+    Numbers the joined facilities 1 to n, in the order of the MOUD file.
+    '''
+    destinations = destinations.reset_index(drop=True)
     destinations['ID'] = destinations.index + 1
     destinations = destinations[~destinations.GEOID.isna()]
     destinations['GEOID'] = destinations['GEOID'].astype(str)
 
-    if save:
-        save_path = os.path.join(outpath, 'inputs', geo, state_abbr, f'{state_abbr.upper()}-{resource[:3]}-moud-dests.csv')
-        destinations['dX'] = destinations.geometry.x
-        destinations['dY'] = destinations.geometry.y
-        (destinations
-        .drop('geometry', axis = 1)
-        .to_csv(save_path, index=False)
-        )
-        print(f"{state_abbr} destinations saved to {save_path}")
-        return None
-
     return destinations
 
-def create_origins_file(state_abbr, outpath, geo='tract', save=False):
+def save_destinations(destinations, save_path):
+    destinations = destinations.copy()
+    destinations['dX'] = destinations.geometry.x
+    destinations['dY'] = destinations.geometry.y
+    (destinations
+    .drop('geometry', axis = 1)
+    .to_csv(save_path, index=False)
+    )
+    print(f"Destinations saved to {save_path}")
+
+def destinations_file_path(state_abbr, outpath, resource='all', geo='tract'):
+    return os.path.join(outpath, 'inputs', geo, state_abbr, f'{state_abbr.upper()}-{resource[:3]}-moud-dests.csv')
+
+def transformed_matrix_path(state_abbr, outpath, resource='all', geo='tract'):
     '''
+    Returns the path of a resource type's transformed matrix as written by
+    create_resource_files and refresh_destinations,
+    [state]-transformed-matrix.csv for all facilities and
+    [state]-[res]-transformed-matrix.csv for a single resource type.
+    create_transformed_matrix writes [state]-transformed-matrix.csv for any
+    resource type unless it is given this path.
     '''
-    origins_file_name = utils.get_resource_file_name(state_abbr, geo) + '.shp'
-    origins_path = os.path.join(outpath, 'shapefiles', geo, state_abbr, origins_file_name)
-    origins = gpd.read_file(origins_path)
+    prefix = state_abbr.upper() if resource == 'all' else f'{state_abbr.upper()}-{resource[:3]}'
+    return os.path.join(outpath, 'inputs', geo, state_abbr, f'{prefix}-transformed-matrix.csv')
+
+def facility_keys(facilities, columns):
+    '''
+    Returns a hash of each facility's attributes and coordinates rounded to
+    6 decimal places, used to match facilities across MOUD file versions.
+
+    Attributes are compared as the text they are saved as in the destinations
+    file, so values that read_csv would re-type, e.g. ZIP codes with leading
+    zeros, match whichever side they come from.
+    '''
+    text = facilities[columns].to_csv(index=False)
+    keys = pd.read_csv(io.StringIO(text), dtype=str, keep_default_na=False)
+    keys['dX'] = facilities['dX'].round(6).astype(str).to_numpy()
+    keys['dY'] = facilities['dY'].round(6).astype(str).to_numpy()
+
+    return pd.util.hash_pandas_object(keys, index = False).to_numpy()
+
+def update_destinations_file(state_abbr, moud_file, outpath, resource='all', geo='tract'):
+    '''
+    Updates the saved destinations file of a resource type with a new version
+    of the MOUD file, only joining the facilities that were added to the
+    regional boundaries.
+
+    Facilities are matched to the previous destinations on their attributes
+    and coordinates. Facilities that are still listed keep their ID, new
+    facilities get IDs after the largest existing ID and closed facilities
+    are dropped. If there is no previous destinations file it is created
+    from scratch with create_destinations_file.
+
+    Parameters
+    ----------
+    state_abbr : str
+
+    moud_file : str
+
+    outpath : str
+
+    resource : str
+
+    geo : str
+
+    Returns
+    -------
+    added : DataFrame
+        Destinations added to the file, with their GEOID and ID
+    removed : list
+        IDs of the destinations dropped from the file
+    '''
+    assert resource in RESOURCES + ['all'], "Not a valid resource type."
+
+    save_path = destinations_file_path(state_abbr, outpath, resource, geo)
+    if not os.path.exists(save_path):
+        create_destinations_file(state_abbr, moud_file, outpath, resource, geo, save=True)
+        return pd.read_csv(save_path, dtype={'GEOID':'str'}), []
+
+    previous = pd.read_csv(save_path, dtype=str, keep_default_na=False)
+    previous = previous.astype({'ID': int, 'dX': float, 'dY': float})
+
+    mouds_shp = gpd.read_file(moud_file)
+    if resource != 'all':
+        mouds_shp = mouds_shp[mouds_shp['category'] == resource]
+    mouds_shp.geometry = mouds_shp.geometry.to_crs(epsg = 4326)
+    mouds_shp['dX'] = mouds_shp.geometry.x
+    mouds_shp['dY'] = mouds_shp.geometry.y
+
+    columns = [c for c in mouds_shp.columns if c not in ('geometry', 'dX', 'dY')]
+    new_keys = facility_keys(mouds_shp, columns)
+    previous_keys = facility_keys(previous, columns)
+
+    kept = previous[np.isin(previous_keys, new_keys)]
+    removed = previous.loc[~np.isin(previous_keys, new_keys), 'ID'].tolist()
+    changed = mouds_shp[~np.isin(new_keys, previous_keys)]
+
+    if len(changed):
+        bordering_states = utils.get_bordering_states(state_abbr, outpath)
+        regional_shp = utils.border_states_geodf(bordering_states, geo, outpath, columns = ['GEOID10'], crs = 4326)
+
+        raw_destinations = read_raw_matrix(state_abbr, outpath, geo, columns=['destination']).destination.cat.categories
+
+        added = (gpd.sjoin(changed, regional_shp[['GEOID10', 'geometry']], how='inner', predicate='intersects')
+                 .rename(columns={'GEOID10':'GEOID'})
+                 .drop(['index_right', 'geometry'], axis = 1)
+                 )
+        added = added[added['GEOID'].isin(raw_destinations)].reset_index(drop=True)
+        added['GEOID'] = added['GEOID'].astype(str)
+        added['ID'] = added.index + 1 + (previous.ID.max() if len(previous) else 0)
+        added = added[previous.columns]
+    else:
+        added = previous.iloc[:0]
+
+    destinations = pd.concat([kept, added], ignore_index = True)
+    destinations.to_csv(save_path, index=False)
+    print(f"{state_abbr} destinations updated in {save_path}: {len(added)} added, {len(removed)} removed, "
+          f"{len(kept)} unchanged")
+
+    return added, removed
+
+def update_transformed_matrix(state_abbr, outpath, added, removed, resource='all', geo='tract'):
+    '''
+    Patches the saved transformed matrix for added and removed destinations,
+    see update_destinations_file, instead of rebuilding it.
+
+    The columns of removed destinations are dropped and only the rows of the
+    raw matrix going to the tracts of added destinations are read to build
+    their columns. Origins that only reach added destinations are appended
+    with 999 for the existing columns. Origins left without any reachable
+    destination keep their row of 999s, as with pad_origins.
+
+    Parameters
+    ----------
+    state_abbr : str
+
+    outpath : str
+
+    added : DataFrame
+        Added destinations with GEOID and ID columns
+
+    removed : list
+        IDs of the removed destinations
+
+    resource : str
+
+    geo : str
+    '''
+    matrix_path = transformed_matrix_path(state_abbr, outpath, resource, geo)
+    matrix = pd.read_csv(matrix_path, dtype={'origin':'str'}).set_index('origin')
+    matrix = matrix.drop(columns=[str(i) for i in removed])
+
+    if len(added):
+        raw_matrix = read_raw_matrix(state_abbr, outpath, geo, destinations=added.GEOID)
 
-    origins.geometry = origins.geometry.to_crs(epsg = 4326)
+        facilities = added.sort_values('ID')
+        patch = (cost_matrix.CostMatrix.from_long(raw_matrix.origin, raw_matrix.destination, raw_matrix.minutes)
+                 .select_destinations(facilities.GEOID, labels=facilities.ID.astype(int).astype(str))
+                 .to_frame()
+                 .set_index('origin'))
+
+        origins = matrix.index.append(patch.index.difference(matrix.index))
+        matrix = matrix.reindex(origins, fill_value=cost_matrix.SENTINEL)
+        matrix[patch.columns] = patch.reindex(origins, fill_value=cost_matrix.SENTINEL)
+
+    matrix.reset_index().to_csv(matrix_path, index=False)
+    print(f"{state_abbr} transformed matrix updated in {matrix_path}: {len(added)} columns added, "
+          f"{len(removed)} removed")
+
+def refresh_destinations(state_abbr, moud_file, outpath, resource='all', geo='tract'):
+    '''
+    Brings the destinations file and the transformed matrix up to date with a
+    new version of the MOUD file, only joining and routing the facilities
+    that changed.
+    '''
+    matrix_path = transformed_matrix_path(state_abbr, outpath, resource, geo)
+    if not os.path.exists(destinations_file_path(state_abbr, outpath, resource, geo)) or not os.path.exists(matrix_path):
+        create_destinations_file(state_abbr, moud_file, outpath, resource, geo, save=True)
+        create_transformed_matrix(state_abbr, outpath, resource, geo, save=True, path=matrix_path)
+        return
+
+    added, removed = update_destinations_file(state_abbr, moud_file, outpath, resource, geo)
+    if len(added) or removed:
+        update_transformed_matrix(state_abbr, outpath, added, removed, resource, geo)
+
+def create_origins_file(state_abbr, outpath, geo='tract', save=False):
+    '''
+    '''
+    origins = utils.read_resource(state_abbr, geo, outpath, crs = 4326)
     origins = origins.rename(columns={'GEOID10':'GEOID'})
 
     if save:
@@ -93,45 +285,171 @@ def create_origins_file(state_abbr, outpath, geo='tract', save=False):
 
     return origins
 
-def create_transformed_matrix(state_abbr, outpath, resource='all', geo='tract', parts=None, pad_origins=True, save=False):
+def create_transformed_matrix(state_abbr, outpath, resource='all', geo='tract', parts=None, pad_origins=True, save=False,
+                              as_frame=True, path=None):
     '''
+    Creates the origin by facility matrix of travel minutes for one resource
+    type, with 999 for facilities that cannot be reached from an origin.
+
+    Parameters
+    ----------
+    state_abbr : str
+
+    outpath : str
+
+    resource : str
+
+    geo : str
+
+    parts : int
+
+    pad_origins : bool, default True
+        Add rows of 999 for origins in the origins file without any minutes
+
+    save : bool, default False
+        Write the matrix to [state]-transformed-matrix.csv instead of
+        returning it
+
+    as_frame : bool, default True
+        Return the wide DataFrame, if False return the CostMatrix
+
+    path : str, optional
+        Path to save the matrix to instead of [state]-transformed-matrix.csv,
+        e.g. transformed_matrix_path
+
+    Returns
+    -------
+    DataFrame or cost_matrix.CostMatrix
     '''
-    raw_matrix_file_name = f'{state_abbr}-matrix-TRACT.csv'
-    raw_matrix_file_path = os.path.join(outpath, 'outputs', geo, state_abbr, raw_matrix_file_name)
-    raw_matrix = pd.read_csv(raw_matrix_file_path, dtype={'destination':'str'})
+    raw_matrix = read_raw_matrix(state_abbr, outpath, geo)
 
     origins_file_name = f'{state_abbr.upper()}-origins.csv'
     origins_path = os.path.join(outpath, 'inputs', geo, state_abbr, origins_file_name)
     origins = gpd.read_file(origins_path)
 
-    destinations_file_name = f'{state_abbr.upper()}-{resource[:3]}-moud-dests.csv'
-    destinations_file_path = os.path.join(outpath, 'inputs', geo, state_abbr, destinations_file_name)
+    dests_path = destinations_file_path(state_abbr, outpath, resource, geo)
 
-    if not os.path.exists(destinations_file_path):
-        print(f"{destinations_file_path} not found. Must create destinations for {resource} MOUD type.")
+    if not os.path.exists(dests_path):
+        print(f"{dests_path} not found. Must create destinations for {resource} MOUD type.")
         return None
-    destinations = pd.read_csv(destinations_file_path, dtype={'destination':'str', 'GEOID':'str'})
-
-    cost_matrix_w_ids = raw_matrix.merge(destinations[['ID', 'GEOID']], how='left', left_on='destination', right_on='GEOID')
-    cost_matrix_w_ids = cost_matrix_w_ids[~cost_matrix_w_ids.ID.isna()]
-    cost_matrix_w_ids = cost_matrix_w_ids.drop(columns=['destination','GEOID']).rename(columns={'ID':'destination'}) # drop extra columns
-    cost_matrix_w_ids.destination = cost_matrix_w_ids.destination.astype(int)
-    cost_matrix_w_ids.minutes = cost_matrix_w_ids.minutes.astype(float)
-    cost_matrix_w_ids = cost_matrix_w_ids[['origin', 'destination', 'minutes']]
-    m_cost_matrix = cost_matrix_w_ids.pivot_table(index='origin', columns='destination', values='minutes', fill_value=999)
-    m_cost_matrix =  m_cost_matrix.reset_index().rename_axis(None, axis=1)
-    m_cost_matrix.origin = m_cost_matrix.origin.astype(str)
+    destinations = pd.read_csv(dests_path, dtype={'destination':'str', 'GEOID':'str'})
 
-    if pad_origins:
-        missing_origins = origins[~(origins.GEOID.isin(m_cost_matrix.origin))]
-        fill_origins = pd.DataFrame(index = missing_origins.GEOID, columns = m_cost_matrix.columns[1:m_cost_matrix.shape[1]]).fillna(999)
-        fill_origins = fill_origins.reset_index().rename(columns={'GEOID':'origin'})
-        m_cost_matrix = m_cost_matrix.append(fill_origins)
+    tract_matrix = cost_matrix.CostMatrix.from_long(raw_matrix.origin, raw_matrix.destination, raw_matrix.minutes)
+
+    m_cost_matrix = facility_matrix(tract_matrix, destinations, origins.GEOID if pad_origins else None)
 
     if save:
-        save_path = os.path.join(outpath, 'inputs', geo, state_abbr, f'{state_abbr.upper()}-transformed-matrix.csv')
-        m_cost_matrix.to_csv(save_path, index=False)
+        save_path = path or os.path.join(outpath, 'inputs', geo, state_abbr, f'{state_abbr.upper()}-transformed-matrix.csv')
+        m_cost_matrix.to_csv(save_path)
         print(f"{state_abbr} transformed matrix saved to {save_path}")
         return None
 
+    return m_cost_matrix.to_frame() if as_frame else m_cost_matrix
+
+def facility_matrix(tract_matrix, destinations, origins=None):
+    '''
+    Selects the columns of the tract matrix for each facility, sorted by ID,
+    and drops the origins without any minutes.
+
+    Parameters
+    ----------
+    tract_matrix : cost_matrix.CostMatrix
+        Origin by destination tract matrix
+    destinations : DataFrame
+        Facilities with GEOID and ID columns
+    origins : list-like, optional
+        Origins to add rows of 999 for, if they have no minutes
+    '''
+    facilities = destinations[destinations.GEOID.isin(tract_matrix.destinations)].sort_values('ID')
+    m_cost_matrix = (tract_matrix
+                     .select_destinations(facilities.GEOID, labels=facilities.ID.astype(int))
+                     .drop_empty_origins())
+    m_cost_matrix.origins = m_cost_matrix.origins.astype(str)
+
+    if origins is not None:
+        m_cost_matrix = m_cost_matrix.pad_origins(origins)
+
     return m_cost_matrix
+
+def create_resource_files(state_abbr, moud_file, outpath, resources=RESOURCES, geo='tract', pad_origins=True,
+                          save=False, as_frame=True):
+    '''
+    Creates the destinations and transformed matrix of several resource types
+    in one pass.
+
+    The regional boundaries, the MOUD file and the raw matrix are read once,
+    all facilities are joined to the boundaries in a single spatial join and
+    the tract matrix is built once. Each resource type then only selects its
+    facilities and their columns of the tract matrix. The destinations and
+    matrices are the same as calling create_destinations_file and
+    create_transformed_matrix for each resource type, only the matrices are
+    saved to transformed_matrix_path so those of several resource types do
+    not overwrite each other.
+
+    Parameters
+    ----------
+    state_abbr : str
+
+    moud_file : str
+
+    outpath : str
+
+    resources : list, default RESOURCES
+        Resource types to create, 'all' can be included for all facilities
+
+    geo : str
+
+    pad_origins : bool, default True
+        Add rows of 999 for origins in the origins file without any minutes
+
+    save : bool, default False
+        Write the destinations and matrix of each resource type to
+        destinations_file_path and transformed_matrix_path instead of
+        returning them
+
+    as_frame : bool, default True
+        Return the matrices as wide DataFrames, if False return CostMatrix
+
+    Returns
+    -------
+    dict
+        (destinations, matrix) keyed on resource type
+    '''
+    assert all(r in RESOURCES + ['all'] for r in resources), "Not a valid resource type."
+
+    bordering_states = utils.get_bordering_states(state_abbr, outpath)
+    regional_shp = utils.border_states_geodf(bordering_states, geo, outpath, columns = ['GEOID10'], crs = 4326)
+
+    raw_matrix = read_raw_matrix(state_abbr, outpath, geo)
+    tract_matrix = cost_matrix.CostMatrix.from_long(raw_matrix.origin, raw_matrix.destination, raw_matrix.minutes)
+    del raw_matrix
+
+    origins = None
+    if pad_origins:
+        origins_path = os.path.join(outpath, 'inputs', geo, state_abbr, f'{state_abbr.upper()}-origins.csv')
+        origins = pd.read_csv(origins_path, usecols=['GEOID'], dtype={'GEOID':'str'}).GEOID
+
+    mouds_shp = gpd.read_file(moud_file)
+    mouds_shp.geometry = mouds_shp.geometry.to_crs(epsg = 4326)
+
+    joined = (gpd.sjoin(mouds_shp, regional_shp[['GEOID10', 'geometry']], how='inner', predicate='intersects')
+              .rename(columns={'GEOID10':'GEOID'})
+              .drop('index_right', axis = 1)
+              )
+    joined = joined[joined['GEOID'].isin(tract_matrix.destinations)]
+
+    outputs = {}
+    for resource in resources:
+        facilities = joined if resource == 'all' else joined[joined['category'] == resource]
+        destinations = number_destinations(facilities)
+        m_cost_matrix = facility_matrix(tract_matrix, destinations, origins)
+
+        if save:
+            save_destinations(destinations, destinations_file_path(state_abbr, outpath, resource, geo))
+            save_path = transformed_matrix_path(state_abbr, outpath, resource, geo)
+            m_cost_matrix.to_csv(save_path)
+            print(f"{state_abbr} {resource} transformed matrix saved to {save_path}")
+        else:
+            outputs[resource] = (destinations, m_cost_matrix.to_frame() if as_frame else m_cost_matrix)
+
+    return outputs
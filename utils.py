@@ -1,12 +1,22 @@
 import os
-import csv
+import json
 import glob
-import urllib
+import shutil
+import urllib.request
 import zipfile
+import tempfile
 import centroids
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 FIPS =  {"al":"01","ak":"02","az":"04","ar":"05","ca":"06","co":"08",
          "ct":"09","de":"10","dc":"11","fl":"12","ga":"13","hi":"15",
          "id":"16","il":"17","in":"18","ia":"19","ks":"20","ky":"21",
@@ -29,6 +39,12 @@ rFIPS = {'01':'al','02':'ak','04':'az','05':'ar','06':'ca','08':'co',
          '54':'wv','55':'wi','56':'wy','60':'as','66':'gu','69':'mp',
          '72':'pr','78':'vi','us':'us'}
 
+# Width GEOIDs read as integers are zero padded back to. The OSRM inputs, the
+# parts and matrices built from them, and the centroids all use these widths.
+GEOID_WIDTH = {'zip'   : 7,
+               'tract' : 11,
+               'county': 3}
+
 def get_resource_file_name(state_abbr, geo, year=2010):
     '''
     Generates filename for desired state and geo type.
@@ -128,34 +144,60 @@ def setup_dirs(state_abbr, geo, outdir):
     return dir_paths
 
 
-def download_and_extract_file(dl_url, dl_dir):
+def download_and_extract_file(dl_url, dl_dir, extract=True):
     '''
     Given the download url and a download directory path, this function will
     download the file only if it has not already been downloaded.
 
+    The zip is downloaded to a temporary file and extracted into a temporary
+    directory, both unique to the call, and only moved into dl_dir once
+    complete, so an interrupted run or a concurrent download of the same file
+    never leaves a truncated zip or a partial extraction behind.
+
     Parameters
     ----------
     dl_url : str
         URL for the file to download
     dl_dir : str
         Directory where the downloaded file should be saved
+    extract : bool, default True
+        Extract the zip, if False its members are read straight from the
+        archive, see resource_path
     '''
     zip_file = dl_url.split('/')[-1]
+    filepath = os.path.join(dl_dir, zip_file)
 
-    if not os.path.isfile(os.path.join(dl_dir, zip_file)):
+    if not os.path.isfile(filepath):
         print(f'Downloading {zip_file}...')
-        filepath =  os.path.join(dl_dir, zip_file)
-        urllib.request.urlretrieve(dl_url, filepath)
+        fd, part_path = tempfile.mkstemp(dir = dl_dir, prefix = '.' + zip_file, suffix = '.part')
+        os.close(fd)
+        try:
+            urllib.request.urlretrieve(dl_url, part_path)
+            os.replace(part_path, filepath)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
         print('Downloaded!')
     else:
         print(f"Skipping {zip_file}, it's already downloaded.")
 
     dbf_file = zip_file[:-4] + ".dbf"
+    if not extract:
+        return dbf_file
+
     if not os.path.isfile(os.path.join(dl_dir, dbf_file)):
         print(f'Extracting {zip_file}...')
-        tract_zip = zipfile.ZipFile(os.path.join(dl_dir, zip_file))
-        tract_zip.extractall(os.path.join(dl_dir))
-        tract_zip.close()
+        tmp_dir = tempfile.mkdtemp(dir = dl_dir, prefix = '.extract-')
+        try:
+            with zipfile.ZipFile(filepath) as tract_zip:
+                members = [m for m in tract_zip.namelist() if not m.endswith('/')]
+                tract_zip.extractall(tmp_dir)
+
+            # The .dbf marks a complete extraction, so it is moved last
+            for member in sorted(members, key = lambda x: x == dbf_file):
+                os.replace(os.path.join(tmp_dir, member), os.path.join(dl_dir, member))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
         print('Extracted!')
     else:
         print(f"Skipping {zip_file}, it's already extracted.")
@@ -163,7 +205,60 @@ def download_and_extract_file(dl_url, dl_dir):
     return dbf_file
 
 
-def get_resource(state_abbr, geo, outpath, year = 2010):
+def download_files(downloads, workers=4):
+    '''
+    Downloads and extracts several files at once with a pool of threads.
+
+    Parameters
+    ----------
+    downloads : list
+        (url, download directory) or (url, download directory, extract)
+        tuples, see download_and_extract_file
+    workers : int, default 4
+        Maximum number of files downloaded at the same time
+
+    Returns
+    -------
+    List of the .dbf file name of each download
+    '''
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        return list(executor.map(lambda download: download_and_extract_file(*download), downloads))
+
+
+def prefetch_resources(resources, outpath, workers=4, year=2010, extract=True):
+    '''
+    Creates the directories for, downloads and extracts several resources at
+    once, so later get_resource calls find them on disk.
+
+    Parameters
+    ----------
+    resources : list
+        (state_abbr, geo) tuples of the resources to fetch
+    outpath : str
+        Path of directory where the shapefiles folder should be created
+    workers : int, default 4
+        Maximum number of files downloaded at the same time
+    year : {2010}, default 2010
+    extract : bool, default True
+        Extract the downloaded zips
+
+    Returns
+    -------
+    resources : dict
+        (download directory, output directory, file name) keyed on
+        (state_abbr, geo), as returned by get_resource
+    '''
+    resources = list(dict.fromkeys((state.lower(), geo) for state, geo in resources))
+    dirs = [setup_dirs(state, geo, outpath) for state, geo in resources]
+    urls = [get_resource_url(state, geo, year) for state, geo in resources]
+
+    files = download_files([(url, dl_dir, extract) for url, (dl_dir, out_dir) in zip(urls, dirs)], workers)
+
+    return {resource: (dl_dir, out_dir, file)
+            for resource, (dl_dir, out_dir), file in zip(resources, dirs, files)}
+
+
+def get_resource(state_abbr, geo, outpath, year = 2010, extract = True):
     '''
     Creates download and output directories, downloads, and extracts needed
     files.
@@ -178,6 +273,10 @@ def get_resource(state_abbr, geo, outpath, year = 2010):
 
     year : {2010}, default 2010
 
+    extract : bool, default True
+        Extract the downloaded zip, if False use resource_path to read its
+        members from the archive
+
     Returns
     -------
     Tuple of the output directory path, download directory path and the file
@@ -186,12 +285,164 @@ def get_resource(state_abbr, geo, outpath, year = 2010):
     '''
     dl_dir, out_dir = setup_dirs(state_abbr, geo, outpath)
     url = get_resource_url(state_abbr, geo, year)
-    file = download_and_extract_file(url, dl_dir)
+    file = download_and_extract_file(url, dl_dir, extract)
 
     return (dl_dir, out_dir, file)
 
 
-def get_bordering_states(state_abbr, outpath):
+def resource_path(dl_dir, file, ext='.shp'):
+    '''
+    Returns the path of a member of a downloaded resource, pointing inside the
+    zip archive with GDAL's /vsizip/ prefix if it was not extracted.
+
+    Parameters
+    ----------
+    dl_dir : str
+        Download directory of the resource
+    file : str
+        File name returned by get_resource
+    ext : str, default '.shp'
+        Extension of the member, e.g. '.shp' or '.dbf'
+
+    Returns
+    -------
+    path : str
+        Path that gpd.read_file and dbf_reader.read_dbf can open
+    '''
+    member = file[:-4] + ext
+    path = os.path.join(dl_dir, member)
+
+    if os.path.isfile(path):
+        return path
+
+    return '/vsizip/' + os.path.join(dl_dir, file[:-4] + '.zip') + '/' + member
+
+
+def read_resource(state_abbr, geo, outpath, columns=None, crs=None, geometry=True, year=2010, extract=True):
+    '''
+    Reads the shapefile of a resource, downloading it first if needed.
+
+    The first read converts the shapefile to GeoParquet next to it, in the
+    requested CRS, and later reads are served from that file reading only the
+    requested columns. Without pyarrow the shapefile is read every time.
+
+    Parameters
+    ----------
+    state_abbr : str
+        Two letter abbreviation for state
+    geo : {'tract', 'county', 'zip', 'block', 'state'}
+        String name of the boundary level to use
+    outpath : str
+        Path of directory where the shapefiles folder should be created
+    columns : list, optional
+        Attribute columns to read, defaults to all
+    crs : int, optional
+        EPSG code to reproject to, defaults to the shapefile's CRS
+    geometry : bool, default True
+        Read the geometry column, if False a DataFrame is returned
+    year : int
+        Year of TIGER data to use
+    extract : bool, default True
+        Extract the downloaded zip, if False the shapefile is read from the
+        archive
+
+    Returns
+    -------
+    GeoDataFrame, or DataFrame if geometry is False
+    '''
+    dl_dir, out_dir, file = get_resource(state_abbr, geo, outpath, year = year, extract = extract)
+    shp_path = resource_path(dl_dir, file, '.shp')
+
+    if pyarrow is None:
+        gdf = gpd.read_file(shp_path, ignore_geometry = not geometry)
+        if crs is not None and geometry:
+            gdf = gdf.to_crs(epsg = crs)
+        return gdf[columns + ['geometry'] if geometry else columns] if columns else gdf
+
+    cache_path = os.path.join(dl_dir, file[:-4] + (f'.epsg{crs}' if crs else '') + '.parquet')
+
+    if not os.path.isfile(cache_path):
+        print(f'Converting {file[:-4]} to GeoParquet...')
+        gdf = gpd.read_file(shp_path)
+        if crs is not None:
+            gdf = gdf.to_crs(epsg = crs)
+        # Several processes may convert the same shapefile, each writes its
+        # own temporary file and the identical results replace each other
+        fd, tmp_path = tempfile.mkstemp(dir = dl_dir, prefix = '.' + file[:-4], suffix = '.parquet')
+        os.close(fd)
+        try:
+            gdf.to_parquet(tmp_path, index = False)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    if not geometry:
+        return pd.read_parquet(cache_path, columns = columns)
+
+    return gpd.read_parquet(cache_path, columns = columns + ['geometry'] if columns else None)
+
+
+STATE_ADJACENCY = {}
+
+
+def get_state_adjacency(outpath, buffer=.5, year=2010):
+    '''
+    Returns the bordering states of every state, computed for all states at
+    once with a single spatial join of the buffered state boundaries.
+
+    The table is saved as json next to the US state shapefile and kept in
+    memory, so it is only recomputed for a new buffer distance or year.
+
+    Parameters
+    ----------
+    outpath : str
+        Path of directory where the shapefiles folder should be created
+    buffer : float, default .5
+        Degrees each state is buffered by before looking for intersecting
+        states
+    year : int
+        Year of TIGER data to use
+
+    Returns
+    -------
+    adjacency : dict
+        List of bordering state abbreviations, including the state itself,
+        keyed on state abbreviation
+    '''
+    dl_dir = os.path.join(outpath, 'shapefiles', 'state', 'US')
+    table_path = os.path.join(dl_dir, f'state_adjacency_{year}_{buffer}.json')
+
+    if table_path in STATE_ADJACENCY:
+        return STATE_ADJACENCY[table_path]
+
+    if os.path.isfile(table_path):
+        with open(table_path) as fp:
+            adjacency = json.load(fp)
+
+    else:
+        states = read_resource('US', 'state', outpath, columns = ['STATEFP10'], year = year).reset_index(drop = True)
+        buffered = states.copy()
+        buffered['geometry'] = states.buffer(buffer)
+
+        bordering = gpd.sjoin(states, buffered, how = 'inner', predicate = 'intersects')
+        bordering = bordering[bordering.STATEFP10_left.isin(rFIPS) & bordering.STATEFP10_right.isin(rFIPS)]
+        bordering = bordering.sort_index(kind = 'stable')
+
+        adjacency = {}
+        for left, right in zip(bordering.STATEFP10_left, bordering.STATEFP10_right):
+            adjacency.setdefault(rFIPS[right], []).append(rFIPS[left])
+
+        with open(table_path + '.tmp', 'w') as fp:
+            json.dump(adjacency, fp)
+        os.replace(table_path + '.tmp', table_path)
+
+    STATE_ADJACENCY[table_path] = adjacency
+
+    return adjacency
+
+
+def get_bordering_states(state_abbr, outpath, buffer=.5, year=2010):
     '''
     Creates a list of state abbreviations for all states that border state_abbr.
 
@@ -201,27 +452,26 @@ def get_bordering_states(state_abbr, outpath):
 
     outpath : str
 
+    buffer : float, default .5
+        Degrees state_abbr is buffered by before looking for intersecting
+        states
+
+    year : int, default 2010
+
     Returns
     -------
     states_list : list
         list of state abbreviations for all states that border state_abbr
     '''
-    dl_dir, out_dir, file = get_resource('US', 'state', outpath)
-
-    states = gpd.read_file(os.path.join(dl_dir, file))
-
     if state_abbr.lower() == 'dc':
         return ['va', 'md', 'de', 'dc']
 
-    origin_state = states.copy()[states.STATEFP10 == FIPS[state_abbr.lower()]]
-    origin_state['geometry'] = origin_state.buffer(.5)
-    bordering = gpd.sjoin(states, origin_state, how = 'inner', op = 'intersects')
-    states_list = [rFIPS[x] for x in list(bordering.STATEFP10_left)]
+    adjacency = get_state_adjacency(outpath, buffer, year)
 
-    return states_list
+    return list(adjacency.get(state_abbr.lower(), []))
 
 
-def border_states_geodf(states, geo, outpath):
+def border_states_geodf(states, geo, outpath, columns=None, crs=None):
     '''
     Returns the geo level GeoDataFrame for all states provided in the states
     list input.
@@ -234,17 +484,16 @@ def border_states_geodf(states, geo, outpath):
         String name of the boundary level to use
     outpath : str
         path of directory where output folder should be created
+    columns : list, optional
+        Attribute columns to read, defaults to all
+    crs : int, optional
+        EPSG code to reproject to, defaults to the shapefiles' CRS
 
     Returns
     -------
     GeoDataFrame of all the  for the states in the input list
     '''
-    file_paths = []
-    for state in states:
-        dl_dir, out_dir, file = get_resource(state, geo, outpath)
-        file_paths.append(os.path.join(dl_dir, file))
-
-    return pd.concat([gpd.read_file(path) for path in file_paths])
+    return pd.concat([read_resource(state, geo, outpath, columns = columns, crs = crs) for state in states])
 
 
 def get_pwcs(states, geo, outpath, replace=False):
@@ -268,36 +517,217 @@ def get_pwcs(states, geo, outpath, replace=False):
     pwc_files = []
 
     for state in states:
-        pwc_file_path = centroids.compute_geo_centroids(state, geo, outpath, replace)
+        pwc_file_path = centroids.compute_geo_centroids(state, geo, outpath, replace = replace)
         pwc_files.append(pwc_file_path)
 
     pwcs = pd.concat([pd.read_csv(path) for path in pwc_files])
 
-    zfill = {'zip'   : 7,
-             'tract' : 11,
-             'county': 3}
-
-    pwcs['GEOID'] = pwcs['GEOID'].apply(lambda x: str(x).zfill(zfill[geo]))
+    pwcs['GEOID'] = pwcs['GEOID'].apply(lambda x: str(x).zfill(GEOID_WIDTH[geo]))
 
     return pwcs[['GEOID', 'X', 'Y']]
 
-def aggregate_parts(state_abbr, geo, outpath):
+COPY_BUFFER = 16 * 1024 * 1024
+
+MATRIX_DTYPES = {'origin': 'int64', 'destination': 'int64', 'minutes': 'float32'}
+
+
+
+def aggregate_parts(state_abbr, geo, outpath, sidecar=None):
+    '''
+    Concatenates the parts/subset_*.csv files written by
+    osrm_interface.get_durations into a single matrix csv.
+
+    Parts are copied in sorted order with large buffered reads and no per-line
+    parsing. Optionally the matrix is also written in a typed binary format
+    with integer GEOIDs and float32 minutes.
+
+    Parameters
+    ----------
+    state_abbr : str
+        Two letter abbreviation for state
+    geo : {'tract', 'county', 'zip'}
+        String name of the boundary level to use
+    outpath : str
+        Path of directory where output folder was created
+    sidecar : {None, 'npy', 'parquet'}, default None
+        Also write [state]-matrix-[geo].parquet, or a [state]-matrix-[geo]
+        directory of origin, destination and minutes .npy arrays that can be
+        memory-mapped
+
+    Returns
+    -------
+    outfile_path : str
+        Path of the matrix csv
+    '''
     print(f'Working on {state_abbr.upper()}...')
     base_dir = os.path.join(outpath, 'outputs', geo, state_abbr.upper())
     parts_dir = os.path.join(base_dir, 'parts')
-    parts = glob.glob(parts_dir + '/subset_*.csv')
+    parts = sorted(glob.glob(parts_dir + '/subset_*.csv'))
 
     outfile_path = os.path.join(base_dir, f'{state_abbr.upper()}-matrix-{geo.upper()}.csv')
 
-    with open(outfile_path, 'w') as csvfile:
-        csvwriter = csv.writer(csvfile)
-
-        csvwriter.writerow(['origin', 'destination', 'minutes'])
+    with open(outfile_path + '.tmp', 'wb') as out:
+        out.write(b'origin,destination,minutes\r\n')
 
         for file in parts:
-            f = open(file)
-            for line in f:
-                clean_line = line.replace('\n','').split(',')
-                csvwriter.writerow(clean_line)
-            f.close()
+            with open(file, 'rb') as f:
+                shutil.copyfileobj(f, out, COPY_BUFFER)
+
+    os.replace(outfile_path + '.tmp', outfile_path)
+
+    if sidecar is not None:
+        write_matrix_sidecar(outfile_path, sidecar)
+
     print(f'{state_abbr.upper()} has been aggregated!')
+
+    return outfile_path
+
+
+def count_lines(path):
+    lines = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER), b''):
+            lines += block.count(b'\n')
+
+    return lines
+
+
+def write_matrix_sidecar(matrix_path, fmt='npy', chunksize=2000000):
+    '''
+    Writes a matrix csv in a typed binary format, reading it in chunks so the
+    whole matrix is never held in memory.
+
+    Parameters
+    ----------
+    matrix_path : str
+        Path of the matrix csv written by aggregate_parts
+    fmt : {'npy', 'parquet'}, default 'npy'
+        'npy' writes a directory next to the csv holding origin.npy,
+        destination.npy (int64 GEOIDs) and minutes.npy (float32). 'parquet'
+        writes a parquet file with the same columns and requires pyarrow.
+    chunksize : int, default 2000000
+        Number of rows read at a time
+
+    Returns
+    -------
+    path : str
+        Path of the directory or parquet file written
+    '''
+    chunks = pd.read_csv(matrix_path, dtype = MATRIX_DTYPES, chunksize = chunksize)
+
+    if fmt == 'parquet':
+        assert pyarrow is not None, 'pyarrow is required to write parquet.'
+
+        path = matrix_path[:-4] + '.parquet'
+        schema = pyarrow.schema([(column, dtype) for column, dtype in MATRIX_DTYPES.items()])
+        with pyarrow.parquet.ParquetWriter(path + '.tmp', schema) as writer:
+            for chunk in chunks:
+                writer.write_table(pyarrow.Table.from_pandas(chunk, schema = schema, preserve_index = False))
+
+        os.replace(path + '.tmp', path)
+        return path
+
+    assert fmt == 'npy', f'Unknown matrix format {fmt}.'
+
+    path = matrix_path[:-4]
+    tmp_dir = path + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors = True)
+    os.makedirs(tmp_dir)
+
+    n_rows = count_lines(matrix_path) - 1
+    arrays = {column: np.lib.format.open_memmap(os.path.join(tmp_dir, column + '.npy'), mode = 'w+',
+                                                dtype = dtype, shape = (n_rows,))
+              for column, dtype in MATRIX_DTYPES.items()}
+
+    start = 0
+    for chunk in chunks:
+        for column, array in arrays.items():
+            array[start:start + len(chunk)] = chunk[column].to_numpy()
+        start += len(chunk)
+
+    assert start == n_rows, f'Expected {n_rows} rows in {matrix_path}, read {start}.'
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    shutil.rmtree(path, ignore_errors = True)
+    os.replace(tmp_dir, path)
+
+    return path
+
+
+def read_matrix(matrix_path, geo='tract', columns=None, destinations=None, chunksize=2000000):
+    '''
+    Reads a matrix csv written by aggregate_parts with categorical GEOIDs and
+    float32 minutes.
+
+    GEOIDs are parsed as integers and only their unique values are formatted
+    back into zero padded strings, so the matrix takes a fraction of the
+    memory of string columns. If an up to date sidecar written by
+    write_matrix_sidecar sits next to the csv it is read instead, memory
+    mapping the npy arrays.
+
+    Parameters
+    ----------
+    matrix_path : str
+        Path of the matrix csv
+    geo : {'tract', 'county', 'zip'}, default 'tract'
+        Boundary level of the GEOIDs, sets their zero padded width, see
+        GEOID_WIDTH
+    columns : list, optional
+        Columns to read, any of 'origin', 'destination' and 'minutes'.
+        Defaults to all three.
+    destinations : list-like, optional
+        Only keep the rows going to these destination GEOIDs
+    chunksize : int, default 2000000
+        Number of csv rows parsed at a time
+
+    Returns
+    -------
+    DataFrame
+    '''
+    columns = list(columns or MATRIX_DTYPES)
+    read = columns if destinations is None or 'destination' in columns else columns + ['destination']
+    wanted = None if destinations is None else pd.Index(destinations).astype(np.int64).to_numpy()
+
+    def is_current(path):
+        return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(matrix_path)
+
+    npy_dir = matrix_path[:-4]
+    parquet_path = matrix_path[:-4] + '.parquet'
+
+    if is_current(os.path.join(npy_dir, 'minutes.npy')):
+        arrays = {column: np.load(os.path.join(npy_dir, column + '.npy'), mmap_mode = 'r') for column in read}
+        if wanted is not None:
+            keep = np.flatnonzero(np.isin(arrays['destination'], wanted))
+            arrays = {column: array[keep] for column, array in arrays.items()}
+
+    elif pyarrow is not None and is_current(parquet_path):
+        table = pyarrow.parquet.read_table(parquet_path, columns = read)
+        arrays = {column: table.column(column).to_numpy() for column in read}
+        if wanted is not None:
+            keep = np.isin(arrays['destination'], wanted)
+            arrays = {column: array[keep] for column, array in arrays.items()}
+
+    else:
+        chunks = []
+        for chunk in pd.read_csv(matrix_path, usecols = read, dtype = {c: MATRIX_DTYPES[c] for c in read},
+                                 chunksize = chunksize):
+            if wanted is not None:
+                chunk = chunk[np.isin(chunk['destination'].to_numpy(), wanted)]
+            chunks.append(chunk)
+        matrix = pd.concat(chunks, ignore_index = True)
+        arrays = {column: matrix[column].to_numpy() for column in read}
+        del matrix
+
+    width = GEOID_WIDTH[geo.lower()]
+    data = {}
+    for column in columns:
+        if column == 'minutes':
+            data[column] = np.asarray(arrays[column], dtype = np.float32)
+        else:
+            codes, uniques = pd.factorize(np.asarray(arrays[column]), sort = True)
+            data[column] = pd.Categorical.from_codes(codes, pd.Index(uniques).astype(str).str.zfill(width))
+
+    return pd.DataFrame(data)
\ No newline at end of file